@@ -0,0 +1,95 @@
+"""
+Микробенчмарк реестра устройств: чтение без копирования против прежнего
+model_copy() на каждое обращение.
+
+Запуск: python benchmarks/devices_bench.py [кол-во устройств]
+"""
+import os
+import sys
+import tempfile
+import timeit
+from itertools import count as counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'rootfs', 'app'))
+
+from devices import Devices, DeviceModel, DeviceModelsEnum  # noqa: E402
+
+
+class LegacyDevices(Devices):
+    """Поведение реестра до перехода на неизменяемые записи"""
+
+    def update(self, key, data):
+        if key in self._devices:
+            if isinstance(data, DeviceModel):
+                data = data.model_dump(exclude_unset=True)
+            self._devices[key] = self._devices[key].model_copy(update=data)
+        else:
+            self._devices[key] = data
+
+    def __getitem__(self, key):
+        if key not in self._devices:
+            return None
+        return self._devices[key].model_copy()
+
+    def __iter__(self):
+        for key, val in self._devices.items():
+            yield key, val.model_copy()
+
+
+def fill(devices: Devices, count: int):
+    for i in range(count):
+        devices.update(f"light.lamp_{i}", DeviceModel(
+            entity_id=f"lamp_{i}",
+            category="light",
+            name=f"Lamp {i}",
+            state="on",
+            enabled=True,
+            model=DeviceModelsEnum.light,
+            attributes={"brightness": i % 255},
+            features=["brightness"],
+        ))
+
+
+def bench(devices: Devices, count: int, number: int) -> dict[str, float]:
+    keys = list(devices.keys())
+    # События чередуются: повтор того же состояния Devices.update пропускает, а прежний реестр копировал бы
+    events = [{"state": "off", "attributes": {"brightness": 10}}, {"state": "on", "attributes": {"brightness": 200}}]
+    step = counter()
+
+    def read():
+        for key in keys:
+            devices[key]
+
+    def iterate():
+        for _ in devices:
+            pass
+
+    def update():
+        event = events[next(step) % 2]
+        for key in keys:
+            devices.update(key, event)
+
+    return {
+        name: min(timeit.repeat(func, number=number, repeat=3)) / number / count * 1e6
+        for name, func in (("getitem", read), ("iter", iterate), ("update", update))
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cls in (("legacy", LegacyDevices), ("snapshot", Devices)):
+            devices = cls(os.path.join(tmp, f"{name}.json"))
+            fill(devices, count)
+            results[name] = bench(devices, count, number=5)
+
+    print(f"{count} устройств, мкс на операцию")
+    print(f"{'':10}{'legacy':>10}{'snapshot':>10}{'x':>8}")
+    for op in results["legacy"]:
+        legacy, new = results["legacy"][op], results["snapshot"][op]
+        print(f"{op:10}{legacy:10.3f}{new:10.3f}{legacy / new:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Минимальный MQTT 3.1.1 брокер для бенчмарков: CONNECT, SUBSCRIBE/UNSUBSCRIBE,
+PUBLISH с QoS 0-2 (подписчикам доставляется с QoS 0), PINGREQ, DISCONNECT.
+Без сессий, retain и авторизации
+"""
+import asyncio
+import logging
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    pattern_parts = pattern.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(pattern_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+def encode_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def packet(kind: int, body: bytes, flags: int = 0) -> bytes:
+    return bytes((kind << 4 | flags,)) + encode_length(len(body)) + body
+
+
+def publish_packet(topic: str, payload: bytes) -> bytes:
+    topic = topic.encode()
+    return packet(PUBLISH, struct.pack('!H', len(topic)) + topic + payload)
+
+
+class Session:
+    def __init__(self, broker: 'FakeBroker', writer: asyncio.StreamWriter):
+        self.broker = broker
+        self.writer = writer
+        self.subscriptions: set[str] = set()
+
+    def send(self, data: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class FakeBroker:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.sessions: set[Session] = set()
+        self.published = 0  # принято PUBLISH от клиентов
+        self.delivered = 0  # отправлено подписчикам
+        self.server: asyncio.Server | None = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for session in list(self.sessions):
+            session.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def publish(self, topic: str, payload: bytes):
+        data = None
+        for session in self.sessions:
+            if any(topic_matches(pattern, topic) for pattern in session.subscriptions):
+                data = data or publish_packet(topic, payload)
+                session.send(data)
+                self.delivered += 1
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session(self, writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b''
+                if not self.on_packet(session, header[0] >> 4, header[0] & 0x0F, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def on_packet(self, session: Session, kind: int, flags: int, body: bytes) -> bool:
+        match kind:
+            case 1:  # CONNECT
+                session.send(packet(CONNACK, b'\x00\x00'))
+            case 3:  # PUBLISH
+                qos = flags >> 1 & 0x03
+                (size,) = struct.unpack_from('!H', body)
+                topic = body[2:2 + size].decode()
+                offset = 2 + size
+                if qos:
+                    packet_id = body[offset:offset + 2]
+                    offset += 2
+                    session.send(packet(PUBACK if qos == 1 else PUBREC, packet_id))
+                self.published += 1
+                self.publish(topic, body[offset:])
+            case 6:  # PUBREL
+                session.send(packet(PUBCOMP, body[:2]))
+            case 8:  # SUBSCRIBE
+                packet_id, offset, granted = body[:2], 2, bytearray()
+                while offset < len(body):
+                    (size,) = struct.unpack_from('!H', body, offset)
+                    session.subscriptions.add(body[offset + 2:offset + 2 + size].decode())
+                    offset += 2 + size + 1
+                    granted.append(0)
+                session.send(packet(SUBACK, packet_id + bytes(granted)))
+            case 10:  # UNSUBSCRIBE
+                offset = 2
+                while offset < len(body):
+                    (size,) = struct.unpack_from('!H', body, offset)
+                    session.subscriptions.discard(body[offset + 2:offset + 2 + size].decode())
+                    offset += 2 + size
+                session.send(packet(UNSUBACK, body[:2]))
+            case 12:  # PINGREQ
+                session.send(packet(PINGRESP, b''))
+            case 14:  # DISCONNECT
+                return False
+            case _:
+                logging.debug('FakeBroker: пакет %s не поддерживается', kind)
+        return True
@@ -0,0 +1,228 @@
+"""
+Имитация Home Assistant для бенчмарков: GET /api/states и websocket /api/websocket
+(auth, subscribe_events, subscribe_entities, unsubscribe_events, get_states, call_service).
+Состояния - лампы light.bench_<n> с яркостью
+"""
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from itertools import count
+
+from aiohttp import web, WSMsgType
+
+HA_VERSION = '2024.6.0'
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeHomeAssistant:
+    def __init__(self, entities: int, host: str = '127.0.0.1', port: int = 0, seed: int = 1):
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.states: dict[str, dict] = {}
+        self.brightness: dict[str, int] = {}  # последняя яркость, в выключенном состоянии её нет в атрибутах
+        for i in range(entities):
+            on = self.random.random() < 0.5
+            self.states[f'light.bench_{i}'] = self._state(f'light.bench_{i}', on, self.random.randint(20, 255))
+
+        self.connections: set['Connection'] = set()
+        self.subscribed = asyncio.Event()  # бридж подписался на изменения
+        self.on_call_service = None  # вызывается с entity_id для каждого устройства из call_service
+        self.events_sent = 0
+        self.calls = 0
+        self.runner: web.AppRunner | None = None
+
+    @staticmethod
+    def _state(entity_id: str, on: bool, brightness: int) -> dict:
+        attributes = {
+            'friendly_name': entity_id.split('.', 1)[1].replace('_', ' ').title(),
+            'supported_color_modes': ['brightness'],
+            'supported_features': 0,
+        }
+        if on:
+            attributes['color_mode'] = 'brightness'
+            attributes['brightness'] = brightness
+        stamp = now_iso()
+        return {
+            'entity_id': entity_id,
+            'state': 'on' if on else 'off',
+            'attributes': attributes,
+            'last_changed': stamp,
+            'last_updated': stamp,
+            'context': {'id': f'{time.time_ns():x}', 'parent_id': None, 'user_id': None},
+        }
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/states', self.handle_states)
+        app.router.add_get('/api/websocket', self.handle_websocket)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for connection in list(self.connections):
+            await connection.ws.close()
+        await self.runner.cleanup()
+
+    async def handle_states(self, request):
+        return web.json_response(list(self.states.values()))
+
+    async def handle_websocket(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        connection = Connection(self, ws)
+        self.connections.add(connection)
+        try:
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+        return ws
+
+    def set_state(self, entity_id: str, on: bool, brightness: int | None = None):
+        """Меняет состояние и рассылает событие подписчикам"""
+        old_state = self.states[entity_id]
+        if brightness is None:
+            brightness = old_state['attributes'].get('brightness', 255)
+        new_state = self.states[entity_id] = self._state(entity_id, on, brightness)
+        if on:
+            self.brightness[entity_id] = brightness
+        for connection in self.connections:
+            connection.state_changed(old_state, new_state)
+        self.events_sent += 1
+
+    def random_change(self, entity_id: str) -> tuple[bool, int | None]:
+        """Случайное отличающееся от текущего состояние, возвращает (on, brightness)"""
+        current = self.states[entity_id]
+        if current['state'] == 'off' or self.random.random() < 0.5:
+            # Яркость всегда новая, иначе выключение и включение между двумя up/status ничего не меняют для Sber
+            on, brightness = True, self.random.randint(20, 255)
+            if brightness == self.brightness.get(entity_id):
+                brightness = brightness % 255 + 1
+        else:
+            on, brightness = False, None
+        self.set_state(entity_id, on, brightness)
+        return on, brightness
+
+
+class Connection:
+    def __init__(self, ha: FakeHomeAssistant, ws: web.WebSocketResponse):
+        self.ha = ha
+        self.ws = ws
+        self.events: set[int] = set()  # id подписок subscribe_events
+        self.entities: dict[int, set[str]] = {}  # id подписки subscribe_entities -> устройства
+        self.context_ids = count(1)
+        self.outbox: asyncio.Queue[dict] = asyncio.Queue()  # сообщения уходят по порядку отдельной задачей
+
+    def send(self, message: dict):
+        self.outbox.put_nowait(message)
+
+    async def writer(self):
+        while True:
+            message = await self.outbox.get()
+            if self.ws.closed:
+                return
+            await self.ws.send_json(message)
+
+    def result(self, msg_id: int, result=None, success: bool = True):
+        self.send({'id': msg_id, 'type': 'result', 'success': success, 'result': result})
+
+    async def run(self):
+        await self.ws.send_json({'type': 'auth_required', 'ha_version': HA_VERSION})
+        auth = await self.ws.receive_json()
+        if auth.get('type') != 'auth':
+            return
+        await self.ws.send_json({'type': 'auth_ok', 'ha_version': HA_VERSION})
+        writer = asyncio.create_task(self.writer())
+        try:
+            async for msg in self.ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                data = msg.json()
+                for message in data if isinstance(data, list) else [data]:
+                    self.on_message(message)
+        finally:
+            writer.cancel()
+
+    def on_message(self, message: dict):
+        msg_id = message.get('id')
+        match message.get('type'):
+            case 'subscribe_events':
+                self.events.add(msg_id)
+                self.result(msg_id)
+                self.ha.subscribed.set()
+            case 'subscribe_entities':
+                entity_ids = set(message.get('entity_ids') or self.ha.states)
+                self.entities[msg_id] = entity_ids
+                self.result(msg_id)
+                self.send({'id': msg_id, 'type': 'event', 'event': {'a': {
+                    entity_id: self.compressed(self.ha.states[entity_id])
+                    for entity_id in entity_ids if entity_id in self.ha.states
+                }}})
+                self.ha.subscribed.set()
+            case 'unsubscribe_events':
+                subscription = message.get('subscription')
+                self.events.discard(subscription)
+                self.entities.pop(subscription, None)
+                self.result(msg_id)
+            case 'get_states':
+                self.result(msg_id, list(self.ha.states.values()))
+            case 'call_service':
+                self.call_service(msg_id, message)
+            case 'ping':
+                self.send({'id': msg_id, 'type': 'pong'})
+            case _:
+                self.result(msg_id)
+
+    def call_service(self, msg_id: int, message: dict):
+        self.ha.calls += 1
+        entity_ids = message.get('target', {}).get('entity_id', [])
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        on = message.get('service') == 'turn_on'
+        brightness = (message.get('service_data') or {}).get('brightness')
+        for entity_id in entity_ids:
+            if self.ha.on_call_service is not None:
+                self.ha.on_call_service(entity_id)
+            if entity_id in self.ha.states:
+                self.ha.set_state(entity_id, on, brightness)
+        self.result(msg_id, {'context': {'id': f'{next(self.context_ids):026x}'}, 'response': None})
+
+    @staticmethod
+    def compressed(state: dict) -> dict:
+        return {'s': state['state'], 'a': state['attributes'], 'c': state['context']['id'], 'lc': time.time()}
+
+    def state_changed(self, old_state: dict, new_state: dict):
+        entity_id = new_state['entity_id']
+        for subscription in self.events:
+            self.send({'id': subscription, 'type': 'event', 'event': {
+                'event_type': 'state_changed',
+                'data': {'entity_id': entity_id, 'old_state': old_state, 'new_state': new_state},
+                'origin': 'LOCAL',
+                'time_fired': new_state['last_updated'],
+                'context': new_state['context'],
+            }})
+        for subscription, entity_ids in self.entities.items():
+            if entity_id not in entity_ids:
+                continue
+            old_attributes = old_state['attributes']
+            new_attributes = new_state['attributes']
+            diff = {'+': {
+                's': new_state['state'],
+                'a': {k: v for k, v in new_attributes.items() if old_attributes.get(k) != v},
+                'c': new_state['context']['id'],
+                'lu': time.time(),
+            }}
+            if removed := [k for k in old_attributes if k not in new_attributes]:
+                diff['-'] = {'a': removed}
+            self.send({'id': subscription, 'type': 'event', 'event': {'c': {entity_id: diff}}})
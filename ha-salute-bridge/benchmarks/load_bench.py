@@ -0,0 +1,422 @@
+"""
+Нагрузочный бенчмарк бриджа: настоящие SaluteClient и HAApiClient против
+локального MQTT брокера (fake_broker) и имитации Home Assistant (fake_ha).
+
+Бридж запускается в отдельном процессе, поэтому время CPU и пиковая память
+относятся только к нему. Генератор создаёт rate событий state_changed в секунду
+по entities лампам и раз в burst_interval сек. отправляет от Sber команду на
+burst_size устройств. Задержка события - от отправки из HA до up/status с новым
+состоянием, задержка команды - от down/commands до up/status с подтверждением.
+
+Запуск: python benchmarks/load_bench.py --entities 1000 --rate 500 --duration 10
+Настройки бриджа переопределяются через -o key=value (например -o ha_subscribe_mode=entities)
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import aiomqtt
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'rootfs', 'app'))
+
+from fake_broker import FakeBroker  # noqa: E402
+from fake_ha import FakeHomeAssistant  # noqa: E402
+
+LOGIN = 'bench'
+ROOT_TOPIC = f'sberdevices/v1/{LOGIN}'
+
+CATEGORIES = {
+    'light': [
+        {'name': 'online', 'required': True},
+        {'name': 'on_off', 'required': True},
+        {'name': 'light_brightness'},
+    ],
+}
+
+
+def percentiles(values: list[float]):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))] * 1000
+
+    return {"count": len(values), "p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": values[-1] * 1000}
+
+
+def sber_state(on: bool, brightness: int | None):
+    """Состояние лампы в том виде, в каком его передаёт бридж в up/status"""
+    if not on or brightness is None:
+        return on, None
+    return on, min(max(round(brightness / 2.55 * 10), 50), 1000)
+
+
+def prepare_workdir(workdir: str, ha: FakeHomeAssistant):
+    """devices.json с включёнными лампами и categories.json, чтобы не ходить в Sber за категориями"""
+    devices = {
+        entity_id: {
+            "entity_id": entity_id.split('.', 1)[1],
+            "category": "light",
+            "name": state['attributes']['friendly_name'],
+            "state": state['state'],
+            "enabled": True,
+            "model": "light",
+            "features": ["brightness"],
+        }
+        for entity_id, state in ha.states.items()
+    }
+    with open(os.path.join(workdir, 'devices.json'), 'w', encoding='utf-8') as f:
+        json.dump(devices, f)
+    with open(os.path.join(workdir, 'categories.json'), 'w', encoding='utf-8') as f:
+        json.dump(CATEGORIES, f)
+
+
+def run_bridge(workdir: str, options: dict, conn):
+    os.chdir(workdir)
+    asyncio.run(bridge(options, conn))
+
+
+async def bridge(options: dict, conn):
+    """Та же сборка, что в lifespan из main.py, без веб-интерфейса"""
+    from const import CATEGORIES_FILENAME, DEVICES_FILENAME
+    from devices import Devices
+    from ha_api.base import HAApiClient, HA_EVENTS
+    from http_client import HttpClient
+    from logger import Logger
+    from queues import CoalescingQueue, merge_pending
+    from salute.base import SaluteClient
+    from tracing import TRACER
+
+    Logger.init(options)
+    mqtt_queue = CoalescingQueue(
+        key=lambda item: (item["type"], item.get("data")),
+        maxsize=options.get('queue_maxsize', 1000),
+        overflow=options.get('queue_overflow', 'drop_oldest'),
+        name="mqtt",
+        droppable=lambda item: item["type"] == "status",
+        merge=merge_pending,
+    )
+    ha_queue = CoalescingQueue(
+        key=lambda entity_id: entity_id,
+        maxsize=options.get('queue_maxsize', 1000),
+        overflow=options.get('queue_overflow', 'drop_oldest'),
+        name="ha",
+        droppable=lambda entity_id: False,
+    )
+    devices = Devices(
+        DEVICES_FILENAME,
+        save_delay=options.get('save_delay', 2),
+        journal=options.get('save_journal', False),
+        compact_interval=options.get('save_compact_interval', 600),
+    )
+    http = HttpClient()
+    ha_client = HAApiClient(options, queue_write=mqtt_queue, queue_read=ha_queue, devices=devices, http=http)
+    salute_client = SaluteClient(
+        options, queue_write=ha_queue, queue_read=mqtt_queue, devices=devices, categories_file=CATEGORIES_FILENAME,
+        http=http
+    )
+    await asyncio.gather(salute_client.load_categories(), ha_client.startup_load())
+
+    tasks = [
+        asyncio.create_task(salute_client.listen()),
+        asyncio.create_task(salute_client.queue_processer()),
+        asyncio.create_task(ha_client.start()),
+        asyncio.create_task(ha_client.queue_processer()),
+    ]
+    # CPU считаем от начала нагрузки до команды остановки от управляющего процесса
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, conn.recv)
+    cpu_start, wall_start = time.process_time(), time.monotonic()
+    await loop.run_in_executor(None, conn.recv)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    trace = TRACER.report(recent=0)
+    conn.send({
+        "cpu": time.process_time() - cpu_start,
+        "wall": time.monotonic() - wall_start,
+        "cpu_total": usage.ru_utime + usage.ru_stime,
+        "max_rss_kb": usage.ru_maxrss,
+        "status_batches": salute_client.status_batcher.stats.as_dict(),
+        "dispatcher": ha_client.dispatcher.stats(),
+        "queues": {"mqtt": mqtt_queue.stats(), "ha": ha_queue.stats()},
+        "ha_events": {labels[0]: value for labels, value in HA_EVENTS.values.items()},
+        "trace": {"complete": trace["complete"], "stage": trace["stage"]},
+    })
+    for task in tasks:
+        task.cancel()
+    await devices.flush()
+    await http.close()
+
+
+class LoadGenerator:
+    def __init__(self, ha: FakeHomeAssistant, args):
+        self.ha = ha
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.entity_ids = list(ha.states)
+
+        # entity_id -> (время отправки, ожидаемое состояние в up/status)
+        self.pending_events: dict[str, tuple[float, tuple]] = {}
+        self.pending_commands: dict[str, tuple[float, bool]] = {}
+        self.commands_to_ha: dict[str, float] = {}  # команды, ещё не дошедшие до HA
+        self.observed: dict[str, tuple] = {}  # последнее полученное в up/status состояние
+        self.event_latency: list[float] = []
+        self.command_latency: list[float] = []
+        self.command_to_ha_latency: list[float] = []
+        self.superseded = 0  # события, перекрытые следующим для того же устройства до up/status
+        self.events_sent = 0
+        self.commands_sent = 0
+        self.status_messages = 0
+        self.status_devices = 0
+        self.status_bytes = 0
+
+        ha.on_call_service = self.on_call_service
+
+    def on_call_service(self, entity_id: str):
+        if (sent := self.commands_to_ha.pop(entity_id, None)) is not None:
+            self.command_to_ha_latency.append(time.monotonic() - sent)
+
+    def on_status(self, payload: bytes):
+        now = time.monotonic()
+        self.status_messages += 1
+        self.status_bytes += len(payload)
+        for entity_id, data in json.loads(payload)['devices'].items():
+            self.status_devices += 1
+            values = {}
+            for state in data['states']:
+                value = state['value']
+                values[state['key']] = value.get('bool_value', value.get('integer_value'))
+            on = bool(values.get('on_off'))
+            self.observed[entity_id] = (on, values.get('light_brightness'))
+            if (pending := self.pending_commands.get(entity_id)) is not None and pending[1] == on:
+                self.command_latency.append(now - pending[0])
+                del self.pending_commands[entity_id]
+            if (pending := self.pending_events.get(entity_id)) is not None:
+                if pending[1] == (on, values.get('light_brightness')):
+                    self.event_latency.append(now - pending[0])
+                    del self.pending_events[entity_id]
+
+    async def events(self, until: float):
+        start = time.monotonic()
+        sent = 0
+        while (now := time.monotonic()) < until:
+            due = int((now - start) * self.args.rate) - sent
+            for _ in range(due):
+                entity_id = self.random.choice(self.entity_ids)
+                if entity_id in self.pending_commands:
+                    continue
+                on, brightness = self.ha.random_change(entity_id)
+                self.events_sent += 1
+                expected = sber_state(on, brightness)
+                if entity_id in self.pending_events:
+                    self.superseded += 1
+                    if self.observed.get(entity_id) == expected:
+                        # Вернулись к уже отправленному в Sber состоянию: нового up/status не будет
+                        del self.pending_events[entity_id]
+                        continue
+                self.pending_events[entity_id] = (time.monotonic(), expected)
+            sent += due
+            await asyncio.sleep(0.005)
+
+    async def commands(self, client: aiomqtt.Client, until: float):
+        while time.monotonic() + self.args.burst_interval < until:
+            await asyncio.sleep(self.args.burst_interval)
+            free = [e for e in self.entity_ids if e not in self.pending_commands and e not in self.pending_events]
+            devices = {}
+            now = time.monotonic()
+            for entity_id in self.random.sample(free, min(self.args.burst_size, len(free))):
+                on = self.ha.states[entity_id]['state'] != 'on'
+                devices[entity_id] = {'states': [{'key': 'on_off', 'value': {'type': 'BOOL', 'bool_value': on}}]}
+                self.pending_commands[entity_id] = (now, on)
+                self.commands_to_ha[entity_id] = now
+            self.commands_sent += len(devices)
+            await client.publish(f'{ROOT_TOPIC}/down/commands', json.dumps({'devices': devices}))
+
+    async def status_requests(self, client: aiomqtt.Client, until: float):
+        """Полный status_request от Sber: большой ответ не должен задерживать команды"""
+        if not self.args.status_request_interval:
+            return
+        while time.monotonic() + self.args.status_request_interval < until:
+            await asyncio.sleep(self.args.status_request_interval)
+            await client.publish(f'{ROOT_TOPIC}/down/status_request', json.dumps({'devices': []}))
+
+    async def settle(self, timeout: float):
+        """Даём бриджу доставить то, что уже отправлено"""
+        deadline = time.monotonic() + timeout
+        while (self.pending_events or self.pending_commands) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+async def run(args):
+    broker = FakeBroker()
+    await broker.start()
+    ha = FakeHomeAssistant(args.entities, seed=args.seed)
+    await ha.start()
+
+    options = {
+        "sd_mqtt_broker": "127.0.0.1",
+        "sd_mqtt_broker_port": broker.port,
+        "sd_mqtt_tls": False,
+        "sd_mqtt_login": LOGIN,
+        "sd_mqtt_password": LOGIN,
+        "sd_http_api_endpoint": "http://127.0.0.1:1",
+        "ha_api_url": ha.url,
+        "ha_api_token": "bench",
+        "log_level": args.log_level,
+    }
+    for item in args.option:
+        key, value = item.split('=', 1)
+        try:
+            options[key] = json.loads(value)
+        except ValueError:
+            options[key] = value
+
+    generator = LoadGenerator(ha, args)
+    config = asyncio.Event()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare_workdir(workdir, ha)
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=run_bridge, args=(workdir, options, child_conn))
+
+        async with aiomqtt.Client('127.0.0.1', broker.port, identifier='bench-sber') as client:
+            await client.subscribe(f'{ROOT_TOPIC}/up/#')
+
+            async def receive():
+                async for message in client.messages:
+                    if message.topic.matches(f'{ROOT_TOPIC}/up/status'):
+                        generator.on_status(message.payload)
+                    elif message.topic.matches(f'{ROOT_TOPIC}/up/config'):
+                        config.set()
+
+            receiver = asyncio.create_task(receive())
+            process.start()
+            try:
+                await asyncio.wait_for(asyncio.gather(config.wait(), ha.subscribed.wait()), args.startup_timeout)
+                # Начальные статусы после подключения к этой нагрузке не относятся
+                await asyncio.sleep(0.5)
+                status_start = (generator.status_messages, generator.status_devices, generator.status_bytes)
+
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, parent_conn.send, 'start')
+                start = time.monotonic()
+                until = start + args.duration
+                await asyncio.gather(
+                    generator.events(until),
+                    generator.commands(client, until),
+                    generator.status_requests(client, until),
+                )
+                elapsed = time.monotonic() - start
+                await generator.settle(args.settle)
+
+                await loop.run_in_executor(None, parent_conn.send, 'stop')
+                bridge_stats = await loop.run_in_executor(None, parent_conn.recv)
+            finally:
+                receiver.cancel()
+                if process.is_alive() and 'bridge_stats' not in locals():
+                    process.terminate()
+                process.join()
+
+    await ha.stop()
+    await broker.stop()
+
+    messages = generator.status_messages - status_start[0]
+    return {
+        "params": {
+            "entities": args.entities, "rate": args.rate, "duration": args.duration,
+            "burst_size": args.burst_size, "burst_interval": args.burst_interval, "options": args.option,
+        },
+        "elapsed": elapsed,
+        "throughput": {
+            "ha_events": generator.events_sent / elapsed,
+            "status_messages": messages / elapsed,
+            "status_devices": (generator.status_devices - status_start[1]) / elapsed,
+            "status_bytes": (generator.status_bytes - status_start[2]) / elapsed,
+            "commands": generator.commands_sent / elapsed,
+        },
+        "latency_ms": {
+            "event_to_status": percentiles(generator.event_latency),
+            "command_to_ha": percentiles(generator.command_to_ha_latency),
+            "command_to_status": percentiles(generator.command_latency),
+        },
+        "lost": {
+            "events": len(generator.pending_events),
+            "commands": len(generator.pending_commands),
+            "superseded_events": generator.superseded,
+        },
+        "cpu": {
+            "seconds": bridge_stats["cpu"],
+            "utilization": bridge_stats["cpu"] / bridge_stats["wall"],
+            "ms_per_event": bridge_stats["cpu"] / max(generator.events_sent, 1) * 1000,
+        },
+        "max_rss_mb": bridge_stats["max_rss_kb"] / 1024,
+        "bridge": bridge_stats,
+    }
+
+
+def print_report(report: dict):
+    params = report["params"]
+    print(
+        f"{params['entities']} устройств, {params['rate']} событий/с, {report['elapsed']:.1f} с, "
+        f"команды по {params['burst_size']} раз в {params['burst_interval']} с {' '.join(params['options'])}"
+    )
+    print("\nПропускная способность, в секунду:")
+    for name, value in report["throughput"].items():
+        print(f"  {name:20}{value:12.1f}")
+    print("\nЗадержки, мс:")
+    print(f"  {'':20}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for name, value in report["latency_ms"].items():
+        if value is None:
+            print(f"  {name:20}{0:8}")
+            continue
+        print(
+            f"  {name:20}{value['count']:8}{value['p50']:10.1f}{value['p90']:10.1f}"
+            f"{value['p99']:10.1f}{value['max']:10.1f}"
+        )
+    lost = report["lost"]
+    print(f"\nНе дошли до up/status: событий {lost['events']}, команд {lost['commands']}; "
+          f"перекрыто событий: {lost['superseded_events']}")
+    cpu = report["cpu"]
+    print(f"CPU бриджа: {cpu['seconds']:.2f} с ({cpu['utilization']:.0%}), {cpu['ms_per_event']:.3f} мс на событие HA")
+    print(f"Пиковая память бриджа: {report['max_rss_mb']:.1f} МБ")
+    batches = report["bridge"]["status_batches"]
+    print(f"Пачки up/status: {batches['batches']}, в среднем {batches['avg_size']:.1f} устройств")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=200, help='событий HA в секунду')
+    parser.add_argument('--duration', type=float, default=10, help='длительность нагрузки, сек.')
+    parser.add_argument('--burst-size', type=int, default=20, help='устройств в одной команде Sber')
+    parser.add_argument('--burst-interval', type=float, default=1, help='интервал между командами Sber, сек.')
+    parser.add_argument(
+        '--status-request-interval', type=float, default=0, help='интервал между полными status_request, сек.'
+    )
+    parser.add_argument('--settle', type=float, default=5, help='ожидание доставки после нагрузки, сек.')
+    parser.add_argument('--startup-timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('-o', '--option', action='append', default=[], help='настройка бриджа key=value')
+    parser.add_argument('--json', action='store_true', help='вывести отчёт в JSON')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Микробенчмарк сериализации на типичных сообщениях бриджа: стандартный json
+с прежними параметрами против serialization (orjson, если установлен),
+и TypeAdapter, создаваемый на каждый вызов, против закэшированного.
+
+Запуск: python benchmarks/serialization_bench.py [кол-во устройств]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'rootfs', 'app'))
+
+from pydantic import TypeAdapter  # noqa: E402
+
+from devices import DeviceModel, DeviceModelsEnum  # noqa: E402
+from serialization import BACKEND, dumps, loads, type_adapter  # noqa: E402
+
+
+def status_payload(count: int) -> dict:
+    return {'devices': {
+        f'light.lamp_{i}': {'states': [
+            {'key': 'online', 'value': {'type': 'BOOL', 'bool_value': True}},
+            {'key': 'on_off', 'value': {'type': 'BOOL', 'bool_value': i % 2 == 0}},
+            {'key': 'light_brightness', 'value': {'type': 'INTEGER', 'integer_value': 50 + i % 950}},
+        ]}
+        for i in range(count)
+    }}
+
+
+def config_payload(count: int) -> dict:
+    return {'devices': [
+        {
+            'id': f'light.lamp_{i}',
+            'name': f'Лампа {i}',
+            'model_id': '',
+            'model': {
+                'id': f'ID_light.lamp_{i}',
+                'manufacturer': 'HA SaluteBridge',
+                'model': 'Model_light',
+                'category': 'light',
+                'features': ['online', 'on_off', 'light_brightness'],
+            },
+        }
+        for i in range(count)
+    ]}
+
+
+def ha_state(i: int) -> dict:
+    return {
+        'entity_id': f'light.lamp_{i}',
+        'state': 'on',
+        'attributes': {
+            'min_color_temp_kelvin': 2000,
+            'max_color_temp_kelvin': 6535,
+            'supported_color_modes': ['color_temp', 'xy'],
+            'color_mode': 'color_temp',
+            'brightness': i % 255,
+            'color_temp_kelvin': 4000,
+            'hs_color': [27.165, 44.6],
+            'rgb_color': [255, 192, 141],
+            'xy_color': [0.469, 0.378],
+            'friendly_name': f'Лампа {i}',
+            'supported_features': 44,
+        },
+        'last_changed': '2024-06-01T12:00:00.000000+00:00',
+        'last_updated': '2024-06-01T12:00:00.000000+00:00',
+        'context': {'id': '01HZ0000000000000000000000', 'parent_id': None, 'user_id': None},
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    devices = {
+        f'light.lamp_{i}': DeviceModel(
+            entity_id=f'lamp_{i}', category='light', name=f'Лампа {i}', state='on', enabled=True,
+            model=DeviceModelsEnum.light, attributes={'brightness': i % 255}, features=['brightness'],
+        )
+        for i in range(count)
+    }
+    status = status_payload(count)
+    config = config_payload(count)
+    command = json.dumps({'devices': {
+        f'light.lamp_{i}': {'states': [{'key': 'on_off', 'value': {'type': 'BOOL', 'bool_value': True}}]}
+        for i in range(20)
+    }}).encode()
+    event = json.dumps({'id': 5, 'type': 'event', 'event': {
+        'event_type': 'state_changed',
+        'data': {'entity_id': 'light.lamp_1', 'old_state': ha_state(1), 'new_state': ha_state(2)},
+        'origin': 'LOCAL',
+        'time_fired': '2024-06-01T12:00:00.000000+00:00',
+    }}).encode()
+    states = json.dumps([ha_state(i) for i in range(count)]).encode()
+
+    cases = {
+        # название: (прежний вариант, новый вариант, повторов)
+        'status dumps': (
+            lambda: json.dumps(status, ensure_ascii=False, sort_keys=True), lambda: dumps(status), 20
+        ),
+        'config dumps': (
+            lambda: json.dumps(config, ensure_ascii=False, sort_keys=True), lambda: dumps(config), 20
+        ),
+        'command loads': (lambda: json.loads(command), lambda: loads(command), 2000),
+        'ha event loads': (lambda: json.loads(event), lambda: loads(event), 2000),
+        '/api/states loads': (lambda: json.loads(states), lambda: loads(states), 10),
+        'devices as_json': (
+            lambda: TypeAdapter(dict[str, DeviceModel]).dump_json(devices),
+            lambda: type_adapter(dict[str, DeviceModel]).dump_json(devices),
+            20,
+        ),
+        'TypeAdapter only': (
+            lambda: TypeAdapter(dict[str, DeviceModel]),
+            lambda: type_adapter(dict[str, DeviceModel]),
+            200,
+        ),
+    }
+
+    print(f"{count} устройств, мкс на вызов, serialization: {BACKEND}")
+    print(f"{'':20}{'было':>12}{'стало':>12}{'x':>8}")
+    for name, (old, new, number) in cases.items():
+        old_time, new_time = (min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6 for func in (old, new))
+        print(f"{name:20}{old_time:12.1f}{new_time:12.1f}{old_time / new_time:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,2 @@
-from .base import Devices
+from .base import Devices, relevant_attributes
 from .models import *
@@ -1,54 +1,207 @@
-from pydantic import TypeAdapter
+import logging
+import time
+from functools import lru_cache, partial
+from types import MappingProxyType
+from typing import Callable
 
-from utils import json_read
+from serialization import type_adapter
+from storage import Journal, WriteBehind
+from utils import json_read, write_atomic
 from .models import *
 
+# Поля, от которых зависит передаваемое в Sber состояние устройства
+STATE_FIELDS = frozenset(("state", "attributes", "features", "model"))
+# Поля, от которых зависит документ конфигурации для Sber
+CONFIG_FIELDS = frozenset(("enabled", "name", "model", "features", "shard"))
+# После стольких записей журнал сжимается в devices.json, не дожидаясь compact_interval
+JOURNAL_MAX_RECORDS = 1000
+
+
+@lru_cache(maxsize=None)
+def _relevant_attributes(category, model, features) -> frozenset[str]:
+    if model is None and category == "light":
+        model = DeviceModelsEnum.light
+    if model not in MODEL_ATTRIBUTES:
+        # Неизвестная модель - храним всё, как раньше
+        return frozenset(HA_ATTRIBUTES)
+    attrs = MODEL_ATTRIBUTES[model]
+    for feature in features:
+        attrs = attrs | FEATURE_ATTRIBUTES.get(feature, frozenset())
+    return attrs
+
+
+def relevant_attributes(device: DeviceModel) -> frozenset[str]:
+    """Атрибуты HA, от которых зависит состояние устройства для Sber и команды в HA"""
+    return _relevant_attributes(device.category, device.model, tuple(device.features or ()))
+
 
 class Devices:
+    """
+    Реестр устройств. Записи неизменяемые (DeviceModel frozen), поэтому читатели
+    получают их без копирования, а любая запись заменяет устройство целиком.
+    Вложенные attributes/features тоже считаются только для чтения
+    """
     _devices: dict[str, DeviceModel]  # ключи в виде "category.entity_id"
+    _versions: dict[str, int]  # растёт при изменении полей из STATE_FIELDS
+    config_version: int  # растёт при изменении набора устройств или полей из CONFIG_FIELDS
+    registry_version: int  # растёт при любом изменении реестра
 
-    def __init__(self, devices_file):
+    def __init__(self, devices_file, save_delay: float = 0, journal: bool = False, compact_interval: float = 600):
         self._devices = {}
+        self._versions = {}
+        self.config_version = 0
+        self.registry_version = 0
+        self._sorted_keys: tuple[int, list[str]] | None = None  # (config_version, ключи по порядку)
+        # Вызываются синхронно из update(key, запись, изменилась ли конфигурация), должны быть дешёвыми
+        self._listeners: list[Callable[[str, DeviceModel, bool], None]] = []
 
         self.devices_file = devices_file
+        self.writer = WriteBehind(save_delay)
+        self.journal = Journal(f'{devices_file}.journal') if journal else None
+        self.compact_interval = compact_interval
+        self._last_compact = time.monotonic()
+        self._force_compact = False
+        self._dirty: set[str] = set()  # изменённые с последней записи ключи
+        # Состояние взято из devices.json и ещё не подтверждено HA (тёплый старт), только в памяти
+        self.unconfirmed: set[str] = set()
 
         self.load()
 
     def load(self):
         data = json_read(self.devices_file)
         self._devices = {key: DeviceModel(**val) for key, val in data.items()}
+        if self.journal is not None:
+            for record in self.journal.read():
+                self._devices[record['key']] = DeviceModel(**record['device'])
+                self.journal.size += 1
+        self._versions = dict.fromkeys(self._devices, 1)
+        self.config_version += 1
+        self.registry_version += 1
 
     def save(self):
-        with open(self.devices_file, 'wb') as f:
-            f.write(self.as_json(indent=4))
+        """Запись откладывается на save_delay и выполняется вне цикла событий"""
+        self.writer.schedule(self._prepare_save)
+
+    async def flush(self):
+        """Немедленно сохранить все изменения в devices.json (при остановке)"""
+        self._force_compact = True
+        self.writer.schedule(self._prepare_save)
+        await self.writer.flush()
+
+    def _prepare_save(self):
+        # Выполняется на цикле событий: только снимаем ссылки на неизменяемые записи
+        dirty, self._dirty = self._dirty, set()
+        if self.journal is not None and not self._compaction_due():
+            return partial(self._append_journal, [(key, self._devices[key]) for key in dirty])
+        self._force_compact = False
+        self._last_compact = time.monotonic()
+        return partial(self._write_snapshot, dict(self._devices))
+
+    def _compaction_due(self):
+        return (
+            self._force_compact
+            or self.journal.size >= JOURNAL_MAX_RECORDS
+            or time.monotonic() - self._last_compact >= self.compact_interval
+        )
+
+    def _append_journal(self, records: list[tuple[str, DeviceModel]]):
+        if records:
+            self.journal.append([{'key': key, 'device': device.model_dump(mode='json')} for key, device in records])
+
+    def _write_snapshot(self, devices: dict[str, DeviceModel]):
+        write_atomic(self.devices_file, type_adapter(dict[str, DeviceModel]).dump_json(devices, indent=4))
+        if self.journal is not None:
+            self.journal.clear()
 
     def as_json(self, **kwargs):
-        ta = TypeAdapter(dict[str, DeviceModel])
-        return ta.dump_json(self._devices, **kwargs)
+        return type_adapter(dict[str, DeviceModel]).dump_json(self._devices, **kwargs)
 
     def as_dict(self, **kwargs):
-        ta = TypeAdapter(dict[str, DeviceModel])
-        return ta.dump_python(self._devices, **kwargs)
+        return type_adapter(dict[str, DeviceModel]).dump_python(self._devices, **kwargs)
 
     def update(self, key: str, data: DeviceModel | dict):
         if key in self._devices:
+            current = self._devices[key]
             if isinstance(data, DeviceModel):
-                data = data.model_dump(exclude_unset=True)
-            self._devices[key] = self._devices[key].model_copy(update=data)
+                data = {name: getattr(data, name) for name in data.model_fields_set}
+            changed = {name for name, val in data.items() if getattr(current, name) != val}
+            if not changed:
+                return
+            # Новая запись целиком, старая остаётся неизменной у тех, кто её уже прочитал
+            self._devices[key] = current.model_copy(update=data)
+            self._dirty.add(key)
+            self.registry_version += 1
+            if changed & STATE_FIELDS:
+                self._versions[key] += 1
+            if changed & CONFIG_FIELDS:
+                self.config_version += 1
+            self._notify(key, bool(changed & CONFIG_FIELDS))
         else:
             self._devices[key] = data
+            self._dirty.add(key)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self.config_version += 1
+            self.registry_version += 1
+            self._notify(key, True)
+
+    def subscribe(self, listener: Callable[[str, DeviceModel, bool], None]):
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[str, DeviceModel, bool], None]):
+        self._listeners.remove(listener)
+
+    def _notify(self, key: str, config: bool):
+        device = self._devices[key]
+        for listener in self._listeners:
+            try:
+                listener(key, device, config)
+            except Exception:
+                logging.exception('Ошибка в подписчике на изменения устройства %s', key)
+
+    def version(self, key) -> int:
+        """Версия состояния устройства, для кэшей производных от него данных"""
+        return self._versions.get(key, 0)
+
+    def mark_unconfirmed(self):
+        """Все загруженные с диска состояния считаются неподтверждёнными до ответа HA"""
+        self.unconfirmed = set(self._devices)
+        for key in self.unconfirmed:
+            self._versions[key] += 1
+        self.registry_version += 1
+
+    def confirm(self, key) -> bool:
+        """HA подтвердил состояние устройства. True - до этого оно было неподтверждённым"""
+        if key not in self.unconfirmed:
+            return False
+        self.unconfirmed.discard(key)
+        # Меняется передаваемое в Sber состояние (online), сам devices.json - нет
+        self._versions[key] += 1
+        self.registry_version += 1
+        if key in self._devices:
+            self._notify(key, False)
+        return True
 
     def change_state(self, key, value):
-        self._devices[key].state = value
+        self.update(key, {"state": value})
+
+    def get(self, key) -> DeviceModel | None:
+        return self._devices.get(key)
+
+    def snapshot(self) -> MappingProxyType:
+        """Срез реестра на текущий момент, не меняется при последующих update"""
+        return MappingProxyType(dict(self._devices))
 
     def __getitem__(self, key):
-        if key not in self._devices:
-            return None
-        return self._devices[key].model_copy()  # Возвращаем для предотвращения изменений
+        return self._devices.get(key)
 
     def __iter__(self):
-        for key, val in self._devices.items():
-            yield key, val.model_copy()
+        yield from self._devices.items()
 
     def keys(self):
         return self._devices.keys()
+
+    def sorted_keys(self) -> list[str]:
+        """Ключи по алфавиту (для постраничной выдачи), пересчитываются только при смене набора устройств"""
+        if self._sorted_keys is None or self._sorted_keys[0] != self.config_version:
+            self._sorted_keys = (self.config_version, sorted(self._devices))
+        return self._sorted_keys[1]
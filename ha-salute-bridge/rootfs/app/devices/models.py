@@ -4,7 +4,7 @@
 """
 from enum import StrEnum, auto
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class DeviceModelsEnum(StrEnum):
@@ -54,7 +54,36 @@ class HvacUnderfloorAttrsEnum(StrEnum):
     hvac_temp_set = auto()
 
 
+# Атрибуты HA, которые бридж хранит в DeviceModel.attributes
+HA_ATTRIBUTES = (
+    "brightness", "hvac_modes", "preset_modes", "current_temperature", "temperature", "percentage", "percentage_step"
+)
+
+_HVAC_ATTRIBUTES = frozenset(HA_ATTRIBUTES) - {"brightness"}
+
+# Атрибуты, нужные модели независимо от включённых функций.
+# brightness у света нужна всегда: её передаём в HA при включении из Салюта
+MODEL_ATTRIBUTES = {
+    DeviceModelsEnum.light: frozenset(("brightness",)),
+    DeviceModelsEnum.led_strip: frozenset(("brightness",)),
+    DeviceModelsEnum.relay: frozenset(),
+    DeviceModelsEnum.scenario_button: frozenset(),
+    DeviceModelsEnum.sensor_temp: frozenset(),  # температура приходит в state
+    DeviceModelsEnum.hvac_ac: _HVAC_ATTRIBUTES,
+    DeviceModelsEnum.hvac_fan: _HVAC_ATTRIBUTES,
+    DeviceModelsEnum.hvac_radiator: _HVAC_ATTRIBUTES,
+    DeviceModelsEnum.hvac_underfloor_heating: _HVAC_ATTRIBUTES,
+}
+
+# Атрибуты, которые добавляет включённая функция
+FEATURE_ATTRIBUTES = {
+    LightAttrsEnum.brightness: frozenset(("brightness",)),
+}
+
+
 class DeviceModel(BaseModel):
+    model_config = ConfigDict(frozen=True)  # Изменения только через Devices.update
+
     entity_id: str = Field(title="Идентификатор устройства из HA")
     category: str = Field(title="Тип устройства из HA")
     enabled: bool | None = None
@@ -63,3 +92,4 @@ class DeviceModel(BaseModel):
     model: DeviceModelsEnum | None = Field(title="Идентификатор в Salute", default=None)
     attributes: dict | None = None
     features: list[LightAttrsEnum | ButtonAttrsEnum | SensorAttrsEnum | HvacRadiatorAttrsEnum] | None = None
+    shard: str | None = Field(title="Учётная запись Sber (sd_mqtt_login), None - по хэшу", default=None)
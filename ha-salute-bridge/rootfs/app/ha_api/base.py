@@ -1,9 +1,9 @@
 import asyncio
 import logging
 import os
+import time
 from typing import Any, Callable
 
-import requests
 from hass_client.exceptions import (
     CannotConnect,
     ConnectionFailed,
@@ -13,20 +13,36 @@ from hass_client.exceptions import (
 )
 from hass_client.models import Event
 
-from devices import Devices, DeviceModel, DeviceModelsEnum, LightAttrsEnum, ButtonAttrsEnum, SensorAttrsEnum
+from devices import Devices, relevant_attributes, DeviceModel, DeviceModelsEnum, LightAttrsEnum, ButtonAttrsEnum, SensorAttrsEnum
+from http_client import BACKOFF_MAX, BACKOFF_START, RETRIES, HttpClient, StreamError
+from metrics import Counter, RECONNECTS
+from serialization import dumps
 from models.exceptions import NotFoundAgainError, ServiceTimeoutError
+from tracing import TRACER
 from .client import HomeAssistantClient
+from .dispatcher import CommandDispatcher
 
+HA_EVENTS = Counter('salute_ha_events_total', 'События HA: received - получено, dropped - отброшено', ('result',))
 
 class HAApiClient:
-    def __init__(self, options, queue_write, queue_read, devices):
+    def __init__(self, options, queue_write, queue_read, devices, http: HttpClient):
         self.options = options
         self.queue_write = queue_write
         self.queue_read = queue_read
         self.devices: Devices = devices
+        self.http = http
 
         self.connection_task: asyncio.Task | None = None
         self.update_task: asyncio.Task | None = None
+
+        # all - все события HA, entities - subscribe_entities только по включённым устройствам
+        self.subscribe_mode = options.get("ha_subscribe_mode", "all")
+        self.unsubscribe: Callable | None = None
+        self.subscribed_entities: list[str] | None = None
+        self.subscribed_version: int | None = None  # Devices.config_version на момент подписки
+        self.entity_attrs: dict[str, dict] = {}  # полные атрибуты, к ним применяются сжатые дельты
+        # Устройства, которым отправлена команда -> до какого момента (monotonic) ждём её эхо
+        self.pending_echo: dict[str, float] = {}
         self.loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
         self.loop.set_exception_handler(self.handle_exception_in_loop)
 
@@ -44,19 +60,35 @@ class HAApiClient:
         self.client = HomeAssistantClient(self.ha_ws_url, self.ha_api_token)
         self.client.register_on_connection(self.on_connection)
 
+        self.dispatcher = CommandDispatcher(
+            self.call_service,
+            max_in_flight=options.get("ha_max_in_flight", 8),
+            timeout=options.get("ha_command_timeout", 10),
+            on_done=self.on_command_done,
+        )
+
     async def start(self):
         """Handle application start."""
 
         await self.client.connect()
 
     async def on_connection(self):
-        async def on_event(event: Event):
-            await self.handle_exception_in_func(self.on_events, event)
+        # Подписки прежнего соединения больше не действуют
+        self.unsubscribe = None
+        self.subscribed_entities = None
+        if self.subscribe_mode == "entities":
+            await self.handle_exception_in_func(self.resubscribe_entities)
+        else:
+            async def on_event(event: Event):
+                await self.handle_exception_in_func(self.on_events, event)
 
-        await self.handle_exception_in_func(
-            self.client.subscribe_events,
-            on_event,
-        )
+            await self.handle_exception_in_func(
+                self.client.subscribe_events,
+                on_event,
+            )
+            # Пока соединения не было, события терялись. В режиме entities
+            # подписка сама присылает полные состояния, сверка не нужна
+            await self.handle_exception_in_func(self.resync)
 
         if (
             self.update_task is None
@@ -65,10 +97,32 @@ class HAApiClient:
         ):
             self.update_task = self.loop.create_task(self.update())
 
-    @staticmethod
-    async def update():
+    async def update(self):
         while True:
             await asyncio.sleep(0.25)
+            if self.subscribe_mode == "entities" and self.subscribed_version != self.devices.config_version:
+                await self.handle_exception_in_func(self.resubscribe_entities)
+
+    async def resubscribe_entities(self):
+        """Подписка на изменения только включённых устройств, пересоздаётся при смене их набора"""
+        self.subscribed_version = self.devices.config_version
+        entity_ids = sorted(key for key, device in self.devices if device.enabled)
+        if entity_ids == self.subscribed_entities:
+            return
+        if self.unsubscribe is not None:
+            self.unsubscribe()
+            self.unsubscribe = None
+        self.subscribed_entities = entity_ids
+        self.entity_attrs.clear()
+        if not entity_ids:
+            # Пустой список HA трактует как подписку на всё
+            return
+        logging.info('Подписываемся на изменения %s устройств HA', len(entity_ids))
+
+        async def on_entities(event: dict):
+            await self.handle_exception_in_func(self.on_entities, event)
+
+        self.unsubscribe = await self.client.subscribe_entities(on_entities, entity_ids)
 
     def handle_exception_in_loop(
         self, loop: asyncio.AbstractEventLoop, context: dict[str, Any]
@@ -113,6 +167,7 @@ class HAApiClient:
 
                 if self.connection_task is not None and not self.connection_task.done():
                     return
+                RECONNECTS.inc("ha")
                 self.connection_task = self.loop.create_task(
                     self.client.connect()
                 )
@@ -122,80 +177,187 @@ class HAApiClient:
     async def on_events(self, event: Event):
         try:
             # logging.debug("on_events %s", event)
+            HA_EVENTS.inc("received")
             if event.event_type != 'state_changed':
+                HA_EVENTS.inc("dropped")
                 return
             entity_id = event.data['new_state']['entity_id']
             old_state = event.data.get('old_state', {}).get('state')
             new_state = event.data.get('new_state', {}).get('state', "unavailable")
             attrs = event.data['new_state']['attributes']
-            device = self.devices[entity_id]
-            if device is None or not device.enabled:
-                return
-            logging.debug('HA Event: %s: %s -> %s', entity_id, old_state, new_state)
-            device.state = new_state
-            device.attributes = {}
-            if 'brightness' in attrs:
-                device.attributes["brightness"] = attrs["brightness"]
-            if 'hvac_modes' in attrs:
-                device.attributes["hvac_modes"] = attrs["hvac_modes"]
-            if 'preset_modes' in attrs:
-                device.attributes["preset_modes"] = attrs["preset_modes"]
-            if 'current_temperature' in attrs:
-                device.attributes["current_temperature"] = attrs["current_temperature"]
-            if 'temperature' in attrs:
-                device.attributes["temperature"] = attrs["temperature"]
-            if 'percentage' in attrs:
-                device.attributes["percentage"] = attrs["percentage"]
-            if 'percentage_step' in attrs:
-                device.attributes["percentage_step"] = attrs["percentage_step"]
-            self.devices.update(entity_id, device)
-            await self.send_data(entity_id)
+            if not await self.on_state(entity_id, old_state, new_state, attrs):
+                HA_EVENTS.inc("dropped")
         except:
             logging.exception("HA Event failed %s", event.data)
 
-    async def send_data(self, data):
-        await self.queue_write.put({"type": "status", "data": data})
+    async def on_entities(self, event: dict):
+        """
+        Сжатые события subscribe_entities:
+        a - полное состояние, c - изменения (+ добавленные/изменённые, - удалённые атрибуты), r - удалённые
+        """
+        for entity_id, state in event.get("a", {}).items():
+            HA_EVENTS.inc("received")
+            attrs = self.entity_attrs[entity_id] = dict(state.get("a", {}))
+            device = self.devices[entity_id]
+            if not await self.on_state(entity_id, device and device.state, state.get("s", "unavailable"), attrs):
+                HA_EVENTS.inc("dropped")
+        for entity_id, diff in event.get("c", {}).items():
+            HA_EVENTS.inc("received")
+            device = self.devices[entity_id]
+            attrs = self.entity_attrs.setdefault(entity_id, {})
+            for key in diff.get("-", {}).get("a", []):
+                attrs.pop(key, None)
+            added = diff.get("+", {})
+            attrs.update(added.get("a", {}))
+            old_state = device and device.state
+            if not await self.on_state(entity_id, old_state, added.get("s", old_state), attrs):
+                HA_EVENTS.inc("dropped")
+        for entity_id in event.get("r", []):
+            HA_EVENTS.inc("received")
+            self.entity_attrs.pop(entity_id, None)
+            device = self.devices[entity_id]
+            if not await self.on_state(entity_id, device and device.state, "unavailable", {}):
+                HA_EVENTS.inc("dropped")
+
+    async def on_state(self, entity_id, old_state, new_state, attrs) -> bool:
+        """Возвращает False, если событие отброшено"""
+        device = self.devices[entity_id]
+        if device is None or not device.enabled:
+            return False
+        # Эхо нашей команды пропускаем всегда и отправляем в Sber даже без изменений:
+        # по нему Sber получает подтверждение. Просроченное ожидание эхом не считается
+        deadline = self.pending_echo.pop(entity_id, None)
+        echo = deadline is not None and time.monotonic() <= deadline
+        if echo:
+            TRACER.mark(entity_id, "state_changed")
+        if not self.apply_state(entity_id, device, new_state, attrs) and not echo:
+            return False
+        logging.debug('HA Event: %s: %s -> %s', entity_id, old_state, new_state)
+        await self.send_data(entity_id, force=echo)
+        return True
+
+    def apply_state(self, entity_id, device: DeviceModel, new_state, attrs) -> bool:
+        """Записывает состояние HA в реестр, False - для Sber ничего не изменилось"""
+        confirmed = self.devices.confirm(entity_id)
+        attributes = {key: attrs[key] for key in relevant_attributes(device) if key in attrs}
+        if new_state == device.state and attributes == (device.attributes or {}):
+            return confirmed
+        self.devices.update(entity_id, {"state": new_state, "attributes": attributes})
+        return True
+
+    async def resync(self):
+        """Сверка реестра с текущими состояниями HA, в Sber одним сообщением уходят только отличия"""
+        states = await self.client.get_states()
+        seen = set()
+        changed = []
+        for s in states:
+            entity_id = s['entity_id']
+            seen.add(entity_id)
+            device = self.devices[entity_id]
+            if device is None or not device.enabled:
+                continue
+            if self.apply_state(entity_id, device, s.get('state', "unavailable"), s.get('attributes', {})):
+                changed.append(entity_id)
+        # Удалённые из HA за время разрыва
+        for entity_id, device in self.devices:
+            if not device.enabled or entity_id in seen:
+                continue
+            confirmed = self.devices.confirm(entity_id)
+            if device.state != "unavailable":
+                self.devices.change_state(entity_id, "unavailable")
+                changed.append(entity_id)
+            elif confirmed:
+                changed.append(entity_id)
+        logging.info('Сверка с HA: изменилось %s устройств', len(changed))
+        await self.send_resync(changed)
+
+    async def send_data(self, data, force: bool = False):
+        item = {"type": "status", "data": data, "ts": time.monotonic()}
+        if force:
+            item["force"] = True
+        await self.queue_write.put(item)
 
     async def send_conf(self):
         await self.queue_write.put({"type": "conf"})
 
+    async def send_resync(self, entity_ids: list[str]):
+        # Пустой список в resync означает "все устройства", поэтому его не отправляем
+        if entity_ids:
+            await self.queue_write.put({"type": "resync", "data": tuple(entity_ids)})
+
     async def queue_processer(self):
         while True:
             if self.client is not None:
                 break
             await asyncio.sleep(1)
         while True:
-            entity_id = await self.queue_read.get()
+            # Забираем всё, что накопилось: команды одного сообщения Sber приходят разом
+            entity_ids = [await self.queue_read.get()]
+            while not self.queue_read.empty():
+                entity_ids.append(self.queue_read.get_nowait())
+            for req in self.group_commands(dict.fromkeys(entity_ids)):
+                # Эхо ждём не дольше таймаута команды, неудачная команда снимает ожидание сразу
+                deadline = time.monotonic() + self.dispatcher.timeout
+                self.pending_echo.update(dict.fromkeys(req["target"]["entity_id"], deadline))
+                for entity_id in req["target"]["entity_id"]:
+                    TRACER.mark(entity_id, "dispatched")
+                # Не ждём ответа HA: медленная интеграция не задерживает остальные устройства
+                await self.dispatcher.submit(req)
+            for _ in entity_ids:
+                self.queue_read.task_done()
+
+    def on_command_done(self, req: dict, ok: bool):
+        if not ok:
+            for entity_id in req["target"]["entity_id"]:
+                self.pending_echo.pop(entity_id, None)
+
+    async def call_service(self, req):
+        logging.debug('Отправляем команду в HA для %s %s', req["target"]["entity_id"], req)
+        await self.client.send_command("call_service", **req)
+        for entity_id in req["target"]["entity_id"]:
+            TRACER.mark(entity_id, "acked")
+
+    def group_commands(self, entity_ids):
+        """Одинаковые (domain, service, service_data) объединяем в один call_service на несколько устройств"""
+        groups = {}
+        for entity_id in entity_ids:
             try:
-                logging.debug('Отправляем команду в HA для %s', entity_id)
-                device = self.devices[entity_id]
-                match device.category:
-                    case 'light':
-                        data = self.process_light(device)
-                    case 'switch':
-                        data = self.process_switch(device)
-                    case 'input_boolean':
-                        data = self.process_switch(device)
-                    case 'script':
-                        data = self.process_switch(device)
-                    case _:
-                        # Не обрабатываем ничего, кроме этих типов
-                        continue
-                req = {
+                data = self.get_command(entity_id)
+            except:
+                logging.error('Ошибка при обработке %s', entity_id)
+                continue
+            if data is None:
+                continue
+            service_data = data.get('service_data')
+            key = (data["entity_domain"], data["service"], dumps(service_data))
+            if key not in groups:
+                groups[key] = {
                     "domain": data["entity_domain"],
                     "service": data["service"],
                     "target": {
-                        "entity_id": f"{data['entity_domain']}.{data['entity_name']}"
+                        "entity_id": []
                     },
                     "return_response": False
                 }
-                if data.get('service_data'):
-                    req['service_data'] = data['service_data']
-                logging.debug('Отправляем команду в HA для %s %s', entity_id, data)
-                await self.client.send_command("call_service", **req)
-            except:
-                logging.error('Ошибка при обработке %s', entity_id)
-            self.queue_read.task_done()
+                if service_data:
+                    groups[key]['service_data'] = service_data
+            groups[key]["target"]["entity_id"].append(f"{data['entity_domain']}.{data['entity_name']}")
+        return groups.values()
+
+    def get_command(self, entity_id):
+        logging.debug('Отправляем команду в HA для %s', entity_id)
+        device = self.devices[entity_id]
+        match device.category:
+            case 'light':
+                return self.process_light(device)
+            case 'switch':
+                return self.process_switch(device)
+            case 'input_boolean':
+                return self.process_switch(device)
+            case 'script':
+                return self.process_switch(device)
+        # Не обрабатываем ничего, кроме этих типов
+        return None
 
     @staticmethod
     def process_light(device):
@@ -225,102 +387,128 @@ class HAApiClient:
         }
         return data
 
-    async def startup_load(self):
+    async def startup_load(self, publish_changes: bool = False) -> bool:
+        """
+        Загрузка всех состояний из HA. С publish_changes в Sber отправляются состояния
+        включённых устройств, которые отличаются от уже известных. False - HA не ответил
+        """
         hds = {'Authorization': f'Bearer {self.ha_api_token}', 'content-type': 'application/json'}
         url = f'{self.ha_api_url}/states'
         logging.debug('Подключаемся к HA, (ha-api_url: %s)', url)
-        cx = 0
-        ha_dev = []
-        loading = True
-        while cx < 10 and loading:
-            cx = cx + 1
+        versions = {key: self.devices.version(key) for key in self.devices.keys()}
+        loaded = False
+        delay = BACKOFF_START
+        for attempt in range(1, RETRIES + 1):
             try:
-                res = requests.get(url, headers=hds)
-                if res.status_code == 200:
-                    logging.info('Запрос устройств из Home Assistant выполнен штатно.')
-                    ha_dev = res.json()
-                    logging.debug(ha_dev)
-                    loading = False
-                else:
-                    logging.error('ОШИБКА! Запрос устройств из Home Assistant выполнен некоректно. (%s)', str(res.status_code))
-            except:
-                logging.error('Ошибка подключения к HA. Ждём 5 сек перед повторным подключением.')
-                await asyncio.sleep(5)
-
-        for s in ha_dev:
-            category = s['entity_id'].split('.')[0]
-            entity_id = s['entity_id'].split('.')[1]
-            attributes = s.get('attributes', {})
-            dc = attributes.get('device_class', '')
-            fn = attributes.get('friendly_name', '')
-            state = s.get('state', "")
-            match category:
-                case "switch":
-                    logging.debug('switch: %s %s', s['entity_id'], fn)
-                    entity = DeviceModel(
-                        entity_id=entity_id,
-                        category=category,
-                        name=fn,
-                        state=state,
-                        model=DeviceModelsEnum.relay
-                    )
-                    self.devices.update(s['entity_id'], entity)
-                case "light":
-                    logging.debug('light: %s %s', s['entity_id'], fn)
-                    entity = DeviceModel(
-                        entity_id=entity_id,
-                        category=category,
-                        name=fn,
-                        state=state,
-                        # model=DeviceModelsEnum.light
-                    )
-                    if "brightness" in attributes:
-                        entity.attributes = {"brightness": attributes["brightness"]}
-                    self.devices.update(s['entity_id'], entity)
-                case "script":
-                    logging.debug('script: %s %s', s['entity_id'], fn)
-                    entity = DeviceModel(
-                        entity_id=entity_id,
-                        category=category,
-                        name=fn,
-                        state=state,
-                        model=DeviceModelsEnum.relay
-                    )
-                    self.devices.update(s['entity_id'], entity)
-                case "sensor":
-                    if dc == 'temperature':
-                        logging.debug('sensor (temperature): %s %s', s['entity_id'], fn)
-                        entity = DeviceModel(
-                            entity_id=entity_id,
-                            category=category,
-                            name=fn,
-                            state=state,
-                            model=DeviceModelsEnum.sensor_temp,
-                            features=[SensorAttrsEnum.temperature]
-                        )
-                        self.devices.update(s['entity_id'], entity)
-                case "input_boolean":
-                    logging.debug('input_boolean: %s %s', s['entity_id'], fn)
+                # Разбираем ответ потоком, не загружая весь список состояний в память.
+                # Оборвавшийся ответ загружаем заново целиком: load_entity можно применять повторно
+                async for s in self.http.iter_json_array(url, headers=hds):
+                    self.load_entity(s)
+                logging.info('Запрос устройств из Home Assistant выполнен штатно.')
+                loaded = True
+                break
+            except StreamError as ex:
+                if attempt == RETRIES:
+                    logging.error('ОШИБКА! Запрос устройств из Home Assistant не выполнен. (%s)', ex)
+                    break
+                logging.warning('Ответ Home Assistant оборвался (%s), загружаем заново через %s сек.', ex, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
+            except Exception as ex:
+                logging.error('ОШИБКА! Запрос устройств из Home Assistant не выполнен. (%s)', ex)
+                break
+        self.devices.save()
+        await self.send_conf()
+        if publish_changes:
+            changed = [
+                key for key, device in self.devices
+                if device.enabled and self.devices.version(key) != versions.get(key)
+            ]
+            logging.info('Состояния из HA отличаются от сохранённых у %s устройств', len(changed))
+            await self.send_resync(changed)
+        return loaded
+
+    async def warm_start(self):
+        """
+        Тёплый старт: Sber уже обслуживается из devices.json (online=false, см. Devices.mark_unconfirmed),
+        состояния HA догружаются в фоне, и отправляются только отличия. Если HA так и не ответил,
+        состояния придут при подключении к нему (resync)
+        """
+        await self.startup_load(publish_changes=True)
+
+    def load_entity(self, s):
+        self.devices.confirm(s['entity_id'])
+        category = s['entity_id'].split('.')[0]
+        entity_id = s['entity_id'].split('.')[1]
+        attributes = s.get('attributes', {})
+        dc = attributes.get('device_class', '')
+        fn = attributes.get('friendly_name', '')
+        state = s.get('state', "")
+        match category:
+            case "switch":
+                logging.debug('switch: %s %s', s['entity_id'], fn)
+                entity = DeviceModel(
+                    entity_id=entity_id,
+                    category=category,
+                    name=fn,
+                    state=state,
+                    model=DeviceModelsEnum.relay
+                )
+                self.devices.update(s['entity_id'], entity)
+            case "light":
+                logging.debug('light: %s %s', s['entity_id'], fn)
+                entity = DeviceModel(
+                    entity_id=entity_id,
+                    category=category,
+                    name=fn,
+                    state=state,
+                    # model=DeviceModelsEnum.light
+                )
+                if "brightness" in attributes:
+                    entity = entity.model_copy(update={"attributes": {"brightness": attributes["brightness"]}})
+                self.devices.update(s['entity_id'], entity)
+            case "script":
+                logging.debug('script: %s %s', s['entity_id'], fn)
+                entity = DeviceModel(
+                    entity_id=entity_id,
+                    category=category,
+                    name=fn,
+                    state=state,
+                    model=DeviceModelsEnum.relay
+                )
+                self.devices.update(s['entity_id'], entity)
+            case "sensor":
+                if dc == 'temperature':
+                    logging.debug('sensor (temperature): %s %s', s['entity_id'], fn)
                     entity = DeviceModel(
                         entity_id=entity_id,
                         category=category,
                         name=fn,
                         state=state,
-                        model=DeviceModelsEnum.scenario_button,
-                        features=[ButtonAttrsEnum.button_event]
+                        model=DeviceModelsEnum.sensor_temp,
+                        features=[SensorAttrsEnum.temperature]
                     )
                     self.devices.update(s['entity_id'], entity)
-                case "climate":
-                    logging.debug('climate: %s %s', s['entity_id'], fn)
-                    # entity = DeviceModel(
-                    #     entity_id=entity_id,
-                    #     category=category,
-                    #     name=fn,
-                    #     state=state
-                    # )
-                    # self.devices.update(s['entity_id'], entity)
-                case _:
-                    logging.debug('Неиспользуемый тип: %s',s['entity_id'])
-        self.devices.save()
-        await self.send_conf()
+            case "input_boolean":
+                logging.debug('input_boolean: %s %s', s['entity_id'], fn)
+                entity = DeviceModel(
+                    entity_id=entity_id,
+                    category=category,
+                    name=fn,
+                    state=state,
+                    model=DeviceModelsEnum.scenario_button,
+                    features=[ButtonAttrsEnum.button_event]
+                )
+                self.devices.update(s['entity_id'], entity)
+            case "climate":
+                logging.debug('climate: %s %s', s['entity_id'], fn)
+                # entity = DeviceModel(
+                #     entity_id=entity_id,
+                #     category=category,
+                #     name=fn,
+                #     state=state
+                # )
+                # self.devices.update(s['entity_id'], entity)
+            case _:
+                logging.debug('Неиспользуемый тип: %s',s['entity_id'])
 
@@ -71,11 +71,21 @@ class HomeAssistantClient:
 
         return await self.client.subscribe_events(on_event_callback)
 
+    async def subscribe_entities(self, on_event_callback: Callable, entity_ids: list[str]) -> Callable:
+        """Subscribe to compressed state changes of the given entities."""
+
+        return await self.client.subscribe_entities(on_event_callback, entity_ids)
+
     async def send_command(
             self, command: str, **kwargs: dict[str, Any]
     ):
         return await self.client.send_command(command, **kwargs)
 
+    async def get_states(self) -> list[dict]:
+        """Текущие состояния всех сущностей HA"""
+
+        return await self.client.send_command("get_states")
+
     async def call_service(
         self,
         domain: str,
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from metrics import Counter, Histogram
+
+CALL_SERVICE_SECONDS = Histogram('salute_ha_call_service_seconds', 'Время выполнения call_service в HA', ('domain',))
+CALL_SERVICE_ERRORS = Counter('salute_ha_call_service_errors_total', 'Ошибки и таймауты call_service', ('domain',))
+
+
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency: float, ok: bool = True):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        if not ok:
+            self.errors += 1
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg": self.total / self.count if self.count else 0,
+            "max": self.max,
+        }
+
+
+class CommandDispatcher:
+    """
+    Отправка call_service в HA без ожидания ответа на предыдущую команду.
+    Одновременно выполняется не больше max_in_flight команд, команды для одного
+    устройства выполняются строго по порядку, у каждой свой таймаут
+    """
+
+    def __init__(
+        self,
+        send: Callable[[dict], Awaitable],
+        max_in_flight: int = 8,
+        timeout: float = 10,
+        on_done: Callable[[dict, bool], None] | None = None,
+    ):
+        self.send = send
+        self.on_done = on_done  # вызывается после каждой команды: (запрос, выполнена ли она)
+        self.timeout = timeout
+        self.in_flight = 0
+        self.latency: dict[str, LatencyStats] = {}
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tails: dict[str, asyncio.Task] = {}  # последняя команда для каждого устройства
+
+    async def submit(self, req: dict):
+        """Ждёт только свободного места, а не выполнения команды"""
+        await self._slots.acquire()
+        entity_ids = req["target"]["entity_id"]
+        deps = {self._tails[e] for e in entity_ids if e in self._tails}
+        task = asyncio.create_task(self._run(req, deps))
+        for entity_id in entity_ids:
+            self._tails[entity_id] = task
+        task.add_done_callback(lambda t: self._forget(t, entity_ids))
+
+    def _forget(self, task: asyncio.Task, entity_ids: list[str]):
+        for entity_id in entity_ids:
+            if self._tails.get(entity_id) is task:
+                del self._tails[entity_id]
+
+    async def _run(self, req: dict, deps: set[asyncio.Task]):
+        try:
+            if deps:
+                await asyncio.wait(deps)
+            self.in_flight += 1
+            start = time.monotonic()
+            ok = False
+            try:
+                await asyncio.wait_for(self.send(req), self.timeout)
+                ok = True
+            except TimeoutError:
+                logging.error('HA не ответил за %s сек. на команду для %s', self.timeout, req["target"]["entity_id"])
+            except Exception:
+                logging.error('Ошибка при обработке %s', req["target"]["entity_id"])
+            finally:
+                self.in_flight -= 1
+                latency = time.monotonic() - start
+                self.latency.setdefault(req["domain"], LatencyStats()).add(latency, ok)
+                CALL_SERVICE_SECONDS.observe(latency, req["domain"])
+                if not ok:
+                    CALL_SERVICE_ERRORS.inc(req["domain"])
+                if self.on_done is not None:
+                    self.on_done(req, ok)
+        finally:
+            self._slots.release()
+
+    async def drain(self):
+        """Дождаться завершения всех отправленных команд"""
+        if tasks := set(self._tails.values()):
+            await asyncio.wait(tasks)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "latency": {domain: stats.as_dict() for domain, stats in self.latency.items()},
+        }
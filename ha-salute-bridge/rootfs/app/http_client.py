@@ -0,0 +1,188 @@
+import asyncio
+import codecs
+import json
+import logging
+import re
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+import aiohttp
+
+from serialization import loads
+
+RETRIES = 10
+BACKOFF_START = 1  # Seconds
+BACKOFF_MAX = 30
+CHUNK_SIZE = 64 * 1024
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class HttpError(Exception):
+    """Raised when the server answered with an unexpected status."""
+
+    def __init__(self, url: str, status: int):
+        super().__init__(f"HTTP {status}: {url}")
+        self.status = status
+
+
+class StreamError(Exception):
+    """Raised when the response body broke off after a successful status."""
+
+    def __init__(self, url: str, error: Exception):
+        super().__init__(f"{error!r}: {url}")
+        self.error = error
+
+
+class JsonArrayParser:
+    """
+    Потоковый разбор JSON-массива верхнего уровня: feed() принимает очередной кусок текста
+    и возвращает завершившиеся в нём элементы. Элемент считается завершённым, только когда
+    за ним виден разделитель (',' или ']'): число на границе куска может быть неполным ("1500.", "1e", "-")
+    """
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        # start - ждём '[', first - первый элемент или ']', item - элемент после ',',
+        # next - ',' или ']' после элемента, end - массив закрыт
+        self.state = 'start'
+
+    def feed(self, text: str, final: bool = False) -> list:
+        buf = self.buf = self.buf[self.pos:] + text
+        pos = 0
+        items = []
+        while (pos := _WHITESPACE.match(buf, pos).end()) < len(buf):
+            char = buf[pos]
+            match self.state:
+                case 'start':
+                    if char != '[':
+                        raise json.JSONDecodeError("Expecting '['", buf, pos)
+                    self.state = 'first'
+                    pos += 1
+                case 'first' if char == ']':
+                    self.state = 'end'
+                    pos += 1
+                case 'first' | 'item':
+                    try:
+                        item, end = self.decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        if final:
+                            raise
+                        break
+                    after = _WHITESPACE.match(buf, end).end()
+                    if not final and (after == len(buf) or buf[after] not in ',]'):
+                        # Значение может продолжиться в следующем куске
+                        break
+                    items.append(item)
+                    self.state = 'next'
+                    pos = end
+                case 'next':
+                    if char not in ',]':
+                        raise json.JSONDecodeError("Expecting ',' or ']'", buf, pos)
+                    self.state = 'item' if char == ',' else 'end'
+                    pos += 1
+                case 'end':
+                    raise json.JSONDecodeError("Extra data", buf, pos)
+        self.pos = pos
+        if final and self.state != 'end':
+            raise json.JSONDecodeError("Unterminated array", buf, len(buf))
+        return items
+
+
+class HttpClient:
+    """Общий асинхронный HTTP клиент с пулом соединений и повторами запросов"""
+
+    def __init__(self, limit: int = 8, timeout: float = 30):
+        self.limit = limit
+        self.timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия привязывается к циклу событий, поэтому создаём её при первом запросе
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    @asynccontextmanager
+    async def get(self, url: str, retries: int = RETRIES, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        GET с повторами и экспоненциальной задержкой, пока не получим ответ 200
+        (или 304 на условный запрос)
+        """
+        delay = BACKOFF_START
+        for attempt in range(1, retries + 1):
+            try:
+                resp = await self.session.get(url, **kwargs)
+                if resp.status in (200, 304):
+                    break
+                resp.release()
+                error = HttpError(url, resp.status)
+                if 400 <= resp.status < 500 and resp.status != 429:
+                    raise error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                error = ex
+            if attempt == retries:
+                raise error
+            logging.warning('Запрос %s не удался (%s), повтор через %s сек.', url, error, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX)
+        async with resp:
+            yield resp
+
+    async def get_json(self, url: str, **kwargs) -> Any:
+        async with self.get(url, **kwargs) as resp:
+            return await resp.json(loads=loads, content_type=None)
+
+    async def get_json_conditional(
+        self, url: str, validators: dict | None = None, **kwargs
+    ) -> tuple[Any | None, dict | None]:
+        """
+        Условный GET: с ETag/Last-Modified прошлого ответа сервер может ответить 304.
+        Возвращает (None, validators), если документ не изменился, иначе (данные, новые validators)
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        if validators:
+            if etag := validators.get('etag'):
+                headers['If-None-Match'] = etag
+            if modified := validators.get('last_modified'):
+                headers['If-Modified-Since'] = modified
+        async with self.get(url, headers=headers, **kwargs) as resp:
+            if resp.status == 304:
+                return None, validators
+            new_validators = {}
+            if etag := resp.headers.get('ETag'):
+                new_validators['etag'] = etag
+            if modified := resp.headers.get('Last-Modified'):
+                new_validators['last_modified'] = modified
+            return await resp.json(loads=loads, content_type=None), new_validators
+
+    async def iter_json_array(self, url: str, **kwargs) -> AsyncIterator[Any]:
+        """
+        Разбирает ответ вида [item, item, ...] по мере получения, не держа в памяти
+        весь документ (ответ /api/states на больших установках занимает мегабайты)
+        """
+        parser = JsonArrayParser()
+        text = codecs.getincrementaldecoder('utf-8')()
+        async with self.get(url, **kwargs) as resp:
+            chunks = resp.content.iter_chunked(CHUNK_SIZE)
+            eof = False
+            while not eof:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    eof = True
+                    chunk = b''
+                except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                    # Запрос повторами не спасти: часть элементов уже отдана, перезапускать должен вызывающий
+                    raise StreamError(url, ex) from ex
+                for item in parser.feed(text.decode(chunk, final=eof), final=eof):
+                    yield item
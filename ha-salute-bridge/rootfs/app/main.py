@@ -5,23 +5,73 @@ from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from const import CATEGORIES_FILENAME, DEVICES_FILENAME
 from devices import Devices, DeviceModel, DeviceModelsEnum
-from options import load_options
+from http_client import HttpClient
+from metrics import CallbackMetric
+from options import load_options, options_writer
+from queues import CoalescingQueue, Debounce, merge_pending
 from logger import Logger
 from salute.base import SaluteClient
+from salute.categories import CategoriesCache
+from salute.shards import ShardMap, ShardedQueue, accounts_from_options
 from ha_api.base import HAApiClient
 from web.routes import router
+from web.stream import DeviceStream
 
 opt = load_options()
 Logger.init(opt)
 
-mqtt_queue = asyncio.Queue()
-ha_queue = asyncio.Queue()
-
-devices = Devices(DEVICES_FILENAME)
+# Учётные записи Sber: у каждой своё соединение и своя очередь, устройства распределены по ним
+accounts = accounts_from_options(opt)
+shards = ShardMap([account['login'] for account in accounts])
+
+# Очереди с ключом по устройству: новый статус/команда заменяет ещё не обработанный.
+# При переполнении вытесняются только status: conf и resync не теряются
+mqtt_queues = {
+    account['login']: CoalescingQueue(
+        key=lambda item: (item["type"], item.get("data")),
+        maxsize=opt.get('queue_maxsize', 1000),
+        overflow=opt.get('queue_overflow', 'drop_oldest'),
+        name="mqtt" if len(accounts) == 1 else f"mqtt:{account['login']}",
+        droppable=lambda item: item["type"] == "status",
+        merge=merge_pending,
+    )
+    for account in accounts
+}
+# Команды пользователя не вытесняются: по ключу их не больше, чем устройств
+ha_queue = CoalescingQueue(
+    key=lambda entity_id: entity_id,
+    maxsize=opt.get('queue_maxsize', 1000),
+    overflow=opt.get('queue_overflow', 'drop_oldest'),
+    name="ha",
+    droppable=lambda entity_id: False,
+)
+
+CallbackMetric(
+    'salute_queue_depth', 'Элементов в очереди', labelnames=('queue',),
+    func=lambda: {**{(q.name,): q.qsize() for q in mqtt_queues.values()}, ("ha",): ha_queue.qsize()},
+)
+CallbackMetric(
+    'salute_queue_coalesced_total', 'Элементы, заменившие ожидающие в очереди', labelnames=('queue',), kind="counter",
+    func=lambda: {**{(q.name,): q.coalesced for q in mqtt_queues.values()}, ("ha",): ha_queue.coalesced},
+)
+CallbackMetric(
+    'salute_queue_dropped_total', 'Элементы, отброшенные при переполнении очереди', labelnames=('queue',), kind="counter",
+    func=lambda: {**{(q.name,): q.dropped for q in mqtt_queues.values()}, ("ha",): ha_queue.dropped},
+)
+
+devices = Devices(
+    DEVICES_FILENAME,
+    save_delay=opt.get('save_delay', 2),
+    journal=opt.get('save_journal', False),
+    compact_interval=opt.get('save_compact_interval', 600),
+)
+# Со стороны HA и веб-интерфейса очереди шардов выглядят как одна
+mqtt_queue = ShardedQueue(mqtt_queues, shards, devices)
 
 if sys.platform.lower() == "win32" or os.name.lower() == "nt":
     from asyncio import set_event_loop_policy, WindowsSelectorEventLoopPolicy
@@ -30,27 +80,70 @@ if sys.platform.lower() == "win32" or os.name.lower() == "nt":
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    ha_client = HAApiClient(opt, queue_write=mqtt_queue, queue_read=ha_queue, devices=devices)
-    salute_client = SaluteClient(
-        opt, queue_write=ha_queue, queue_read=mqtt_queue, devices=devices, categories_file=CATEGORIES_FILENAME
-    )
-
-    await ha_client.startup_load()
-
-    asyncio.create_task(salute_client.listen())
-    asyncio.create_task(salute_client.queue_processer())
+    http = HttpClient()
+    ha_client = HAApiClient(opt, queue_write=mqtt_queue, queue_read=ha_queue, devices=devices, http=http)
+    categories = CategoriesCache(CATEGORIES_FILENAME, http)
+    salute_clients = [
+        SaluteClient(
+            opt, queue_write=ha_queue, queue_read=mqtt_queues[account['login']], devices=devices,
+            categories_file=CATEGORIES_FILENAME, http=http, account=account, shards=shards,
+            categories_cache=categories,
+        )
+        for account in accounts
+    ]
+
+    async def load_categories():
+        # Первый клиент при необходимости скачивает категории, остальные читают уже готовый файл
+        for client in salute_clients:
+            await client.load_categories()
+
+    # Тёплый старт: есть сохранённые устройства - не ждём HA, подключаемся к Sber сразу
+    warm_start = opt.get('warm_start', True) and len(devices.keys()) > 0
+    if warm_start:
+        devices.mark_unconfirmed()
+        await load_categories()
+        await ha_client.send_conf()
+    else:
+        await asyncio.gather(load_categories(), ha_client.startup_load())
+
+    for client in salute_clients:
+        asyncio.create_task(client.listen())
+        asyncio.create_task(client.queue_processer())
+    asyncio.create_task(salute_clients[0].categories_refresher(salute_clients))
     asyncio.create_task(ha_client.start())
     asyncio.create_task(ha_client.queue_processer())
+    if warm_start:
+        asyncio.create_task(ha_client.warm_start())
+
+    # Правки из веб-интерфейса копятся и уходят в Sber одним документом конфигурации
+    config_publisher = Debounce(
+        lambda: mqtt_queue.put({"type": "conf"}), opt.get('config_publish_delay', 1),
+    )
+
+    yield {
+        "devices": devices,
+        "mqtt_queue": mqtt_queue,
+        "ha_queue": ha_queue,
+        "device_stream": DeviceStream(devices),
+        "shards": shards,
+        "config_publisher": config_publisher,
+    }
 
-    yield {"devices": devices, "mqtt_queue": mqtt_queue, "ha_queue": ha_queue}
+    await config_publisher.flush()
+    await devices.flush()
+    await options_writer.flush()
+    await http.close()
 
 
 fastapi = FastAPI(lifespan=lifespan)
+# Список устройств на больших инсталляциях - сотни килобайт JSON, сжимается в разы
+fastapi.add_middleware(GZipMiddleware, minimum_size=1024)
 
 fastapi.mount("/static", StaticFiles(directory="../app/static"), name="static")
 
 fastapi.include_router(router)
 
+# Открытые потоки /api/v2/devices/stream не должны держать остановку бесконечно
 uvicorn.run(
-    fastapi, host=opt['host'], port=opt['port'], log_level="info"
+    fastapi, host=opt['host'], port=opt['port'], log_level="info", timeout_graceful_shutdown=5
 )
\ No newline at end of file
@@ -0,0 +1,119 @@
+"""
+Метрики в текстовом формате Prometheus.
+Запись - это обновление словаря без блокировок и аллокаций сверх ключа меток,
+поэтому метрики включены всегда
+"""
+from bisect import bisect_left
+from typing import Callable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value) -> str:
+    # Текстовый формат Prometheus: в значении метки экранируются обратная косая черта, кавычка и перевод строки
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        registry.register(self)
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS,
+        registry: Registry = REGISTRY
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам (последняя +Inf), сумма]
+        self.values: dict[tuple, list] = {}
+        registry.register(self)
+
+    def observe(self, value: float, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def render(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for le, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                le = f'le="{le}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class CallbackMetric:
+    """Значение снимается функцией в момент запроса метрик (глубина очереди и т.п.)"""
+
+    def __init__(
+        self, name: str, help: str, func: Callable[[], float | dict[tuple, float]], labelnames: tuple = (),
+        kind: str = "gauge", registry: Registry = REGISTRY
+    ):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = labelnames
+        self.kind = kind
+        registry.register(self)
+
+    def render(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+# Общие для обеих сторон бриджа
+RECONNECTS = Counter('salute_reconnects_total', 'Переподключения к Sber (mqtt) и Home Assistant (ha)', ('side',))
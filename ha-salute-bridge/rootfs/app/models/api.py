@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 from devices.models import LightAttrsEnum
 
@@ -10,4 +10,18 @@ class DevicesEditModel(BaseModel):
 class FeatureEditModel(BaseModel):
     entity_id: str
     feature: LightAttrsEnum
-    state: bool
\ No newline at end of file
+    state: bool
+
+
+class DeviceChangeModel(BaseModel):
+    model_config = ConfigDict(extra='forbid')
+
+    enabled: bool | None = None
+    name: str | None = None
+    features: list[LightAttrsEnum] | None = None
+    shard: str | None = None
+
+
+class DevicesBatchModel(BaseModel):
+    # entity_id -> изменения, применяются все или ни одного
+    devices: dict[str, DeviceChangeModel] = Field(min_length=1)
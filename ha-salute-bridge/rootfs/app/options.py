@@ -1,8 +1,11 @@
 import logging as log
+from functools import partial
 
 from const import OPTIONS_FILENAME
+from storage import WriteBehind
 from utils import json_read, json_write
 
+options_writer = WriteBehind(delay=1)
 
 
 def load_options():
@@ -16,4 +19,5 @@ def options_change(options, key, val):
     if t != val:
         options[key] = val
         log.info('В настройках изменился параметр: %s с %s на %s (обновляю и сохраняю).', key, t, val)
-        json_write(OPTIONS_FILENAME, options)
+        data = dict(options)
+        options_writer.schedule(lambda: partial(json_write, OPTIONS_FILENAME, data))
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from enum import StrEnum, auto
+from itertools import count
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class OverflowPolicy(StrEnum):
+    drop_oldest = auto()  # вытесняем самый старый элемент
+    drop_newest = auto()  # отбрасываем новый элемент
+    block = auto()  # put ждёт освобождения места
+
+
+class _Unique(int):
+    """Ключ элемента, который не объединяется с другими (key вернул None)"""
+
+
+def merge_pending(old: dict, new: dict) -> dict:
+    """
+    Объединение элементов-словарей в очереди: данные от нового, время постановки (ts)
+    от ожидающего - для метрик ожидания, флаг force не теряется
+    """
+    merged = dict(new)
+    if "ts" in old:
+        merged["ts"] = old["ts"]
+    if old.get("force"):
+        merged["force"] = True
+    return merged
+
+
+class CoalescingQueue:
+    """
+    Ограниченная очередь с ключами, совместимая с используемой частью asyncio.Queue.
+    Новый элемент с ключом, который уже ждёт в очереди, заменяет ожидающий
+    (через merge, если задан) и сохраняет его место. Элементы с ключом None не объединяются.
+    При переполнении вытесняются только элементы, для которых droppable вернул True;
+    элементы с ключом None и служебные (droppable - False) принимаются сверх maxsize
+    """
+
+    def __init__(
+        self,
+        key: Callable[[Any], Hashable | None],
+        maxsize: int = 1000,
+        overflow: OverflowPolicy | str = OverflowPolicy.drop_oldest,
+        name: str = "queue",
+        droppable: Callable[[Any], bool] | None = None,
+        merge: Callable[[Any, Any], Any] | None = None,
+    ):
+        self.key = key
+        self.droppable = droppable
+        self.merge = merge
+        self.maxsize = maxsize
+        self.overflow = OverflowPolicy(overflow)
+        self.name = name
+
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._unique = count()
+        self._unfinished = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._items)
+
+    async def put(self, item):
+        key = self._key(item)
+        while (
+            key not in self._items and self.full() and self.overflow == OverflowPolicy.block
+            and self._droppable(key, item)
+        ):
+            self._not_full.clear()
+            await self._not_full.wait()
+        self._put(key, item)
+
+    def put_nowait(self, item):
+        self._put(self._key(item), item)
+
+    def _key(self, item):
+        key = self.key(item)
+        return _Unique(next(self._unique)) if key is None else key
+
+    def _droppable(self, key, item) -> bool:
+        return not isinstance(key, _Unique) and (self.droppable is None or self.droppable(item))
+
+    def _put(self, key, item):
+        if key in self._items:
+            if self.merge is not None:
+                item = self.merge(self._items[key], item)
+            self._items[key] = item
+            self.coalesced += 1
+            return
+        if self.full() and self._droppable(key, item):
+            match self.overflow:
+                case OverflowPolicy.drop_newest:
+                    self._drop(item)
+                    return
+                case _:
+                    # block сюда попадает только из put_nowait
+                    oldest = next((k for k, v in self._items.items() if self._droppable(k, v)), None)
+                    if oldest is None:
+                        # В очереди только служебные элементы: вытеснять нечего, отбрасываем новый
+                        self._drop(item)
+                        return
+                    self._drop(self._items.pop(oldest))
+                    self._unfinished -= 1
+        self._items[key] = item
+        self._unfinished += 1
+        self._finished.clear()
+        self._not_empty.set()
+        if self.full():
+            self._not_full.clear()
+        self.max_depth = max(self.max_depth, len(self._items))
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logging.warning('Очередь %s переполнена, отброшено элементов: %s', self.name, self.dropped)
+        logging.debug('Очередь %s: отброшен %s', self.name, item)
+
+    async def get(self):
+        while not self._items:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if not self._items:
+            raise asyncio.QueueEmpty
+        item = self._items.popitem(last=False)[1]
+        if not self._items:
+            self._not_empty.clear()
+        if not self.full():
+            self._not_full.set()
+        return item
+
+    def task_done(self):
+        if self._unfinished <= 0:
+            raise ValueError('task_done() called too many times')
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def stats(self):
+        return {
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+
+class Debounce:
+    """
+    Отложенный асинхронный вызов: schedule() запускает func после delay секунд
+    без новых schedule(), но не позже max_delay от первого. Серия вызовов - один func()
+    """
+
+    def __init__(self, func: Callable[[], Awaitable], delay: float, max_delay: float | None = None):
+        self.func = func
+        self.delay = delay
+        self.max_delay = max_delay if max_delay is not None else delay * 5
+        self._task: asyncio.Task | None = None
+        self._deadline = 0.0
+        self._first = 0.0
+        self._wake = asyncio.Event()
+
+    def schedule(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._task is None or self._task.done():
+            self._first = now
+            self._wake.clear()
+            self._task = loop.create_task(self._run())
+        self._deadline = min(now + self.delay, self._first + self.max_delay)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while (timeout := self._deadline - loop.time()) > 0 and not self._wake.is_set():
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except TimeoutError:
+                pass
+        try:
+            await self.func()
+        except Exception:
+            logging.exception('Ошибка отложенного вызова')
+
+    async def flush(self):
+        """Выполнить отложенный вызов немедленно"""
+        if self._task is not None and not self._task.done():
+            self._wake.set()
+            await self._task
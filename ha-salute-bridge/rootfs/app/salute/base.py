@@ -1,137 +1,248 @@
 import asyncio
-import json
 import logging
-import os
 import ssl
+import time
+from typing import Callable
 
 import aiomqtt
-import requests
 
-from devices import Devices, DeviceModelsEnum, LightAttrsEnum, ButtonAttrsEnum, SensorAttrsEnum
+from devices import DeviceModel, Devices
+from http_client import HttpClient
+from metrics import Counter, Histogram, RECONNECTS, SIZE_BUCKETS
 from options import options_change
-from utils import json_read, json_write
+from serialization import dumps, loads
+from tracing import TRACER
+from .batcher import StatusBatcher
+from .categories import CategoriesCache
+from .converters import Converters, device_model
+from .shards import ShardMap
+
+MQTT_MESSAGES = Counter('salute_mqtt_messages_total', 'Сообщения MQTT от Sber по типу топика', ('topic',))
+MQTT_PUBLISH = Counter('salute_mqtt_publish_total', 'Отправленные в Sber сообщения', ('topic',))
+MQTT_PUBLISH_BYTES = Histogram(
+    'salute_mqtt_publish_bytes', 'Размер отправленных в Sber сообщений', ('topic',), buckets=SIZE_BUCKETS
+)
+# Очереди обработчиков входящих сообщений
+COMMANDS_LANE = "commands"
+DEFAULT_LANE = "default"
 
 
 class SaluteClient:
-    def __init__(self, options, queue_write, queue_read, devices: Devices, categories_file):
+    def __init__(
+            self, options, queue_write, queue_read, devices: Devices, categories_file, http: HttpClient,
+            account: dict | None = None, shards: ShardMap | None = None,
+            categories_cache: CategoriesCache | None = None,
+    ):
         self.options = options
         self.queue_write = queue_write
         self.queue_read = queue_read
         self.devices = devices
+        self.http = http
+        # Учётная запись Sber этого клиента, по умолчанию основная из настроек
+        self.login = account['login'] if account else options['sd_mqtt_login']
+        self.password = account['password'] if account else options['sd_mqtt_password']
+        self.shards = shards
 
         self.categories_file = categories_file
+        # Кэш категорий общий у клиентов всех учётных записей
+        self.categories_cache = categories_cache or CategoriesCache(categories_file, http)
         self.categories = {}
+        self.categories_version = 0
+        self.categories_checked = False  # категории уже сверены с Sber после запуска
+        self.converters = Converters()
+        # entity_id -> (версия устройства, готовый json-фрагмент '"id": {"states": [...]}')
+        self.states_cache: dict[str, tuple[int, str]] = {}
+        # ((Devices.config_version, categories_version), документ конфигурации)
+        # ((Devices.config_version, categories_version), документ конфигурации, entity_id в нём)
+        self.config_cache: tuple[tuple[int, int], str, frozenset[str]] | None = None
+        self.last_config: str | None = None  # последняя отправленная в Sber конфигурация
+        # Устройства из последней отправленной конфигурации: состояния остальных Sber не отправляем
+        self.declared: frozenset[str] = frozenset()
+        # entity_id -> последний подтверждённый брокером фрагмент, переживает переподключения
+        self.published_states: dict[str, str] = {}
+        self.qos = options.get('sd_mqtt_qos', 1)
 
         self.client = None
-        self.sber_root_topic = f"sberdevices/v1/{options['sd_mqtt_login']}"
+        self.connected = asyncio.Event()  # соединение с брокером установлено и подписки оформлены
+        self.sber_root_topic = f"sberdevices/v1/{self.login}"
         self.stdown = f"{self.sber_root_topic}/down"
 
-        self.load_categories()
+        # Обработчики входящих сообщений: команды в своей очереди, чтобы не ждать status_request
+        self.default_route = ("other", self.on_message, DEFAULT_LANE)
+        self.handler_queues = {
+            lane: asyncio.Queue(maxsize=options.get('queue_maxsize', 1000)) for lane in (COMMANDS_LANE, DEFAULT_LANE)
+        }
+        self.handler_tasks: list[asyncio.Task] = []
+
+        self.status_batcher = StatusBatcher(
+            queue_read,
+            window=options.get('status_batch_window', 0.05),
+            max_size=options.get('status_batch_size', 100),
+        )
+        devices.subscribe(self.on_device_update)
 
     async def listen(self):
+        tls = {}
+        if self.options.get('sd_mqtt_tls', True):
+            tls = dict(
+                tls_params=aiomqtt.TLSParameters(
+                    certfile=None,
+                    keyfile=None,
+                    cert_reqs=ssl.CERT_NONE,
+                    tls_version=None
+                ),
+                tls_insecure=True
+            )
         client = aiomqtt.Client(
             hostname=self.options['sd_mqtt_broker'],
             port=self.options['sd_mqtt_broker_port'],
-            username=self.options['sd_mqtt_login'],
-            password=self.options['sd_mqtt_password'],
-            tls_params=aiomqtt.TLSParameters(
-                certfile=None,
-                keyfile=None,
-                cert_reqs=ssl.CERT_NONE,
-                tls_version=None
-            ),
-            tls_insecure=True
+            username=self.login,
+            password=self.password,
+            **tls
         )
         interval = 5  # Seconds
+        self.start_handlers()
         while True:
             try:
                 async with client:
                     self.client = client
-                    logging.info(f"SaluteClient connected")
+                    routes = self.build_routes()
+                    logging.info("SaluteClient connected (%s)", self.login)
                     await client.subscribe(f"{self.stdown}/#")
                     await client.subscribe("sberdevices/v1/__config")
+                    self.connected.set()
+                    await self.resync()
+                    # Цикл только раскладывает сообщения по очередям, обработка идёт в handler_worker
                     async for message in client.messages:
-                        try:
-                            if message.topic.matches(f"sberdevices/v1/__config"):
-                                self.on_global_conf(message)
-                            elif message.topic.matches(f"{self.stdown}/errors"):
-                                self.on_errors(message)
-                            elif message.topic.matches(f"{self.stdown}/commands"):
-                                await self.on_message_cmd(message)
-                            elif message.topic.matches(f"{self.stdown}/status_request"):
-                                await self.on_message_stat(message)
-                            elif message.topic.matches(f"{self.stdown}/config_request"):
-                                self.on_message_conf(message)
-                            else:
-                                self.on_message(message)
-                        except UnicodeDecodeError:
-                            logging.warning(f"bad message; skip %s", message.payload)
+                        name, handler, lane = routes.get(message.topic.value, self.default_route)
+                        MQTT_MESSAGES.inc(name)
+                        await self.handler_queues[lane].put((handler, message))
             except aiomqtt.MqttError:
+                self.connected.clear()
+                RECONNECTS.inc("mqtt")
                 logging.warning(f"Connection lost; Reconnecting in {interval} seconds ...")
                 await asyncio.sleep(interval)
 
+    async def resync(self):
+        """После (пере)подключения: конфигурация и состояния, только если отличаются от подтверждённых"""
+        await self.queue_read.put({"type": "conf"})
+        await self.queue_read.put({"type": "resync", "data": ()})
+
+    def owns(self, entity_id, device) -> bool:
+        """Устройство передаётся через учётную запись этого клиента"""
+        return self.shards is None or self.shards.shard(entity_id, device) == self.login
+
+    def build_routes(self) -> dict[str, tuple[str, Callable, str]]:
+        """Топик -> (метка для метрик, обработчик, очередь обработчиков). Строится один раз на соединение"""
+        return {
+            "sberdevices/v1/__config": ("global_config", self.on_global_conf, DEFAULT_LANE),
+            f"{self.stdown}/errors": ("errors", self.on_errors, DEFAULT_LANE),
+            f"{self.stdown}/commands": ("commands", self.on_message_cmd, COMMANDS_LANE),
+            f"{self.stdown}/status_request": ("status_request", self.on_message_stat, DEFAULT_LANE),
+            f"{self.stdown}/config_request": ("config_request", self.on_message_conf, DEFAULT_LANE),
+        }
+
+    def start_handlers(self):
+        if self.handler_tasks:
+            return
+        self.handler_tasks = [
+            asyncio.create_task(self.handler_worker(lane, queue)) for lane, queue in self.handler_queues.items()
+        ]
+
+    async def handler_worker(self, lane: str, queue: asyncio.Queue):
+        commands = self.handler_queues[COMMANDS_LANE]
+        while True:
+            handler, message = await queue.get()
+            try:
+                if lane != COMMANDS_LANE:
+                    # Команды в приоритете: остальное ждёт, пока они не будут обработаны
+                    await commands.join()
+                result = handler(message)
+                if asyncio.iscoroutine(result):
+                    await result
+            except UnicodeDecodeError:
+                logging.warning(f"bad message; skip %s", message.payload)
+            except Exception:
+                logging.exception("Ошибка при обработке сообщения %s", message.topic)
+            finally:
+                queue.task_done()
+
     def on_message(self, msg):
         logging.debug("on_message %s %s %s", msg.topic, msg.qos, msg.payload)
 
     async def send_status(self, data):
         logging.debug("send_status:%s", data)
-        await self.client.publish(f"{self.sber_root_topic}/up/status", data)
+        await self.client.publish(f"{self.sber_root_topic}/up/status", data, qos=self.qos)
+        MQTT_PUBLISH.inc("status")
+        MQTT_PUBLISH_BYTES.observe(len(data.encode()), "status")
 
     async def send_config(self, data):
         logging.debug("send_config:%s", data)
-        await self.client.publish(f"{self.sber_root_topic}/up/config", data)
+        await self.client.publish(f"{self.sber_root_topic}/up/config", data, qos=self.qos)
+        MQTT_PUBLISH.inc("config")
+        MQTT_PUBLISH_BYTES.observe(len(data.encode()), "config")
 
     def on_errors(self, msg):
         logging.info("Sber MQTT Errors: %s %s %s", msg.topic, msg.qos, msg.payload)
 
     async def on_message_cmd(self, msg):
-        data = json.loads(msg.payload)
+        data = loads(msg.payload)
         # Command: {'devices': {'Relay_03': {'states': [{'key': 'on_off', 'value': {'type': 'BOOL'}}]}}}
         logging.info("Sber MQTT Command: %s", data)
         for entity_id, v in data['devices'].items():
             device = self.devices[entity_id]
-            if device is None:
+            if device is None or not self.owns(entity_id, device):
+                continue
+            plan = self.converters.plan(device)
+            if plan is None:
                 continue
-            for state in v['states']:
-                val_type = state['value'].get('type', '')
-                val = ''
-                match val_type:
-                    case 'BOOL':
-                        val = state['value'].get('bool_value', False)
-                    case 'INTEGER':
-                        val = int(state['value'].get('integer_value', 0))
-                    case 'ENUM':
-                        val = state['value'].get('enum_value', '')
-                match state['key']:
-                    case 'on_off':
-                        device.state = "on" if val else "off"
-                    case 'light_brightness':
-                        val = round(val / 10 * 2.55)  # приводим из 50-1000 к диапозону 1-255
-                        device.attributes["brightness"] = val
-                    case 'button_event':
-                        device.state = "on" if val == "click" else "off"
-            self.devices.update(entity_id, device)
+            update = plan.command(device, v['states'])
+            trace_id = TRACER.start(entity_id)
+            logging.debug('Команда #%s для %s: %s', trace_id, entity_id, update)
+            self.devices.update(entity_id, update)
             await self.send_data(entity_id)
+            TRACER.mark(entity_id, "queued")
             # await self.send_status(self.devices.do_mqtt_json_states_list([_id]))
         # log(DevicesDB.mqtt_json_states_list)
 
     async def on_message_stat(self, msg):
-        data = json.loads(msg.payload).get('devices', [])
+        data = loads(msg.payload).get('devices', [])
         logging.info("GetStatus: %s", msg.payload)
-        await self.send_status(self.get_salute_states_list(data))
+        await self.publish_states(data)
         # log.debug("Answer: " + self.devices.mqtt_json_states_list)
 
     def on_message_conf(self, msg):
         logging.info("Config: %s %s %s", msg.topic, msg.qos, msg.payload)
 
     def on_global_conf(self, msg):
-        data = json.loads(msg.payload)
+        data = loads(msg.payload)
         options_change(self.options, 'sd_http_api_endpoint', data.get('http_api_endpoint', ''))
 
     async def send_data(self, data):
         await self.queue_write.put(data)
 
+    async def publish_config(self):
+        # Документ строится в момент обработки, поэтому несколько conf подряд в очереди
+        # дают одну отправку: остальные совпадут с уже отправленным
+        config = self.get_salute_devices_list()
+        if config == self.last_config:
+            logging.debug("Конфигурация не изменилась, повторно не отправляем")
+        else:
+            await self.send_config(config)
+            self.last_config = config
+            self.declared = self.config_cache[2]
+        # Новые (включённые, переехавшие) устройства: их состояния отправляются только после
+        # конфигурации с ними. Проверяем и без отправки - после разрыва на прошлой попытке
+        if missing := [entity_id for entity_id in self.declared if entity_id not in self.published_states]:
+            await self.publish_states(missing, changed_only=True)
+
     def get_salute_devices_list(self):
+        key = (self.devices.config_version, self.categories_version)
+        if self.config_cache is None or self.config_cache[0] != key:
+            self.config_cache = (key, *self.build_salute_devices_list())
+        return self.config_cache[1]
+
+    def build_salute_devices_list(self) -> tuple[str, frozenset[str]]:
         manufacturer = 'HA SaluteBridge'
         devices = [{
             "id": "root",
@@ -146,145 +257,180 @@ class SaluteClient:
             }
         }]
         for entity_id, device in self.devices:
-            if not device.enabled:
+            if not device.enabled or not self.owns(entity_id, device):
                 continue
             data = {
                 'id': entity_id,
                 'name': device.name,
                 'model_id': ''
             }
-            if device.model is None:
-                match device.category:
-                    case "light":
-                        device.model = DeviceModelsEnum.light
-                    case _:
-                        continue
-            category = self.categories.get(device.model)
-            features = []
-            for ft in category:
-                if ft.get('required', False):
-                    features.append(ft['name'])
-                elif (
-                    ft['name'] == 'light_brightness' and
-                    device.features and
-                    LightAttrsEnum.brightness in device.features
-                ):
-                    features.append(ft['name'])
-                elif device.features and ft['name'] in device.features:
-                    features.append(ft['name'])
-                # Будем выдавать список из доступных фич для каждого типа в вебе и
-                # юзер сам будет включать их для каждого элемента
+            plan = self.converters.plan(device)
+            if plan is None:
+                continue
             data['model'] = {
                 'id': f'ID_{entity_id}',
                 'manufacturer': manufacturer,
-                'model': 'Model_' + device.model,
-                'category': device.model,
-                'features': features
+                'model': 'Model_' + plan.model,
+                'category': plan.model,
+                'features': plan.features
             }
             devices.append(data)
-        return json.dumps({'devices': devices}, ensure_ascii=False, sort_keys=True)
+        return dumps({'devices': devices}), frozenset(device['id'] for device in devices[1:])
+
+    async def publish_states(
+            self, entitys: list | None = None, changed_only: bool = False, force: set[str] = frozenset(),
+    ) -> int:
+        """
+        Отправляет состояния устройств. С changed_only пропускает устройства, чьё состояние
+        совпадает с последним отправленным, кроме перечисленных в force.
+        Возвращает количество отправленных устройств
+        """
+        fragments = self.get_state_fragments(entitys)
+        if changed_only:
+            fragments = {k: v for k, v in fragments.items() if k in force or self.published_states.get(k) != v}
+            if not fragments:
+                return 0
+        await self.send_status(self.join_state_fragments(fragments.values()))
+        self.published_states.update(fragments)
+        for entity_id in fragments:
+            TRACER.mark(entity_id, "published")
+        return len(fragments)
 
     def get_salute_states_list(self, entitys: list | None = None):
-        devices = {}
+        return self.join_state_fragments(self.get_state_fragments(entitys).values())
+
+    def get_state_fragments(self, entitys: list | None = None) -> dict[str, str]:
         if not entitys:
             entitys = self.devices.keys()
-        for entity_id in entitys:
+        fragments = {}
+        for entity_id in sorted(set(entitys)):
             device = self.devices[entity_id]
-            if device is None or not device.enabled:
+            if device is None or not device.enabled or entity_id not in self.declared:
+                continue
+            if not self.owns(entity_id, device):
                 continue
-            features = self.get_features(device)
-            devices[entity_id] = {'states': features}
-        return json.dumps({'devices': devices}, ensure_ascii=False, sort_keys=True)
-
-    def get_features(self, device):
-        category = self.categories.get(device.model)
-        features = []
-        for ft in category:
-            if ft.get('required'):
-                if ft['name'] == "online":
-                    features.append(self.get_state_value("online", "BOOL", device.state != "unavailable"))
-                elif ft['name'] == "on_off":
-                    features.append(self.get_state_value("on_off", "BOOL", device.state == "on"))
-        match device.category:
-            case 'light':
-                if device.features:
-                    if "brightness" in device.features:
-                        val = device.attributes.get("brightness")
-                        if val is not None:  # Включено, но нету - не передаём
-                            val = round(val / 2.55 * 10)  # приводим из 1-255 к диапозону 50-1000
-                            if val < 50:
-                                val = 50
-                            if val > 1000:
-                                val = 1000
-                            features.append(self.get_state_value("light_brightness", "INTEGER", val))
-            case 'input_boolean':
-                if device.features:
-                    if ButtonAttrsEnum.button_event in device.features:
-                        val = "click" if device.state == "on" else "double_click"
-                        features.append(self.get_state_value("button_event", "ENUM", val))
-            case 'sensor':
-                if device.features:
-                    if SensorAttrsEnum.temperature in device.features:
-                        try:
-                            val = float(device.state)
-                        except:
-                            val = 0
-                        features.append(self.get_state_value("temperature", "INTEGER", val))
-        return features
+            fragments[entity_id] = self.get_state_fragment(entity_id, device)
+        return fragments
 
     @staticmethod
-    def get_state_value(name, data_type, value):
-        r = {}
-        if name == 'temperature':
-            value = value * 10
-        if data_type == 'BOOL':
-            r = {'key': name, 'value': {'type': 'BOOL', 'bool_value': bool(value)}}
-        if data_type == 'INTEGER':
-            r = {'key': name, 'value': {'type': 'INTEGER', 'integer_value': int(value)}}
-        if data_type == 'ENUM':
-            r = {'key': name, 'value': {'type': 'ENUM', 'enum_value': value}}
-        return r
+    def join_state_fragments(fragments):
+        # Собираем тот же документ, что дал бы dumps() целиком
+        return '{"devices":{' + ','.join(fragments) + '}}'
 
+    def get_state_fragment(self, entity_id, device):
+        version = self.devices.version(entity_id)
+        cached = self.states_cache.get(entity_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        states = self.get_features(device, confirmed=entity_id not in self.devices.unconfirmed)
+        fragment = f"{dumps(entity_id)}:{dumps({'states': states})}"
+        self.states_cache[entity_id] = (version, fragment)
+        return fragment
+
+    def on_device_update(self, entity_id: str, device: DeviceModel, config: bool):
+        """
+        Устройство ушло из этого шарда или выключено: забываем отправленное состояние,
+        иначе при возвращении changed_only посчитает его уже отправленным
+        """
+        if config and entity_id in self.published_states and not (device.enabled and self.owns(entity_id, device)):
+            del self.published_states[entity_id]
+            self.states_cache.pop(entity_id, None)
+
+    def get_features(self, device, confirmed: bool = True):
+        plan = self.converters.plan(device)
+        return plan.states(device, confirmed) if plan is not None else []
 
     async def queue_processer(self):
+        # Уже взятые из очереди элементы: следующий за пачкой status и не отправленный из-за разрыва.
+        # task_done для каждого вызывается один раз, когда он обработан
+        backlog: list[dict] = []
         while True:
-            if self.client is not None:
-                break
-            await asyncio.sleep(1)
-        while True:
-            data = await self.queue_read.get()
-            match data["type"]:
-                case "conf":
-                    await self.send_config(self.get_salute_devices_list())
-                case "status":
-                    entity_id = data["data"]
-                    await self.send_status(self.get_salute_states_list([entity_id]))
+            data = backlog.pop(0) if backlog else await self.queue_read.get()
+            await self.connected.wait()
+            try:
+                match data["type"]:
+                    case "conf":
+                        await self.publish_config()
+                    case "status":
+                        # Копим изменения за короткое окно и отправляем одним сообщением
+                        pending, forced, following = await self.status_batcher.collect(data)
+                        if following is not None:
+                            backlog.insert(0, following)
+                        # При разрыве повторяем уже собранную пачку, а не исходный элемент
+                        data = {"type": "batch", "data": pending, "force": forced}
+                        await self.publish_batch(pending, forced)
+                    case "batch":
+                        await self.publish_batch(data["data"], data["force"])
+                    case "resync":
+                        # Одним сообщением, без окна и ограничения размера пачки
+                        published = await self.publish_states(list(data["data"]), changed_only=True)
+                        logging.info("Сверка состояний: отправлено %s устройств", published)
+            except aiomqtt.MqttError as ex:
+                logging.warning(
+                    "Не удалось отправить %s в Sber (%s), повторим после восстановления соединения", data["type"], ex
+                )
+                backlog.insert(0, data)
+                # Разрыв listen замечает не сразу: не крутимся на заведомо неудачных попытках
+                await asyncio.sleep(1)
+                continue
+            except Exception:
+                logging.exception("Ошибка при отправке %s в Sber", data["type"])
             self.queue_read.task_done()
 
-    def load_categories(self):
-        hds = {'content-type': 'application/json'}
-        auth = (self.options['sd_mqtt_login'], self.options['sd_mqtt_password'])
-        categories_url = f"{self.options['sd_http_api_endpoint']}/v1/mqtt-gate/categories"
-        if not os.path.exists(self.categories_file):
-            logging.info('Файл категорий отсутствует. Получаем...')
-            categories = {}
-            SD_Categories = requests.get(
-                categories_url,
-                headers=hds,
-                auth=auth
-            ).json()
-            for id in SD_Categories['categories']:
-                logging.debug('Получаем опции для котегории: %s', id)
-                SD_Features = requests.get(
-                    f"{categories_url}/{id}/features",
-                    headers=hds,
-                    auth=auth
-                ).json()
-                categories[id] = SD_Features['features']
-            #   log(Categories)
-            logging.info('Категории получены. Сохраняем в файл.')
-            json_write('categories.json', categories)
-        else:
+    async def publish_batch(self, pending: dict[str, float], forced: set[str]):
+        published = await self.publish_states(list(pending), changed_only=True, force=forced)
+        self.status_batcher.done(pending, published)
+
+    async def load_categories(self):
+        """Категории с диска сразу, из Sber при запуске - только если файла ещё нет"""
+        if self.categories_cache.load():
             logging.info('Список категорий получен из файла: %s', self.categories_file)
-            categories = json_read(self.categories_file)
-        self.categories = categories
+            self.categories_checked = False
+        else:
+            logging.info('Файл категорий отсутствует. Получаем...')
+            await self.categories_cache.refresh(self.options)
+            self.categories_checked = True
+        self.categories = self.categories_cache.categories
+        self.converters.set_categories(self.categories)
+        self.categories_version += 1
+        self.states_cache.clear()
+
+    async def categories_refresher(self, clients: list["SaluteClient"] | None = None):
+        """
+        Фоновая перепроверка категорий в Sber: сразу после запуска с диска и затем раз в интервал.
+        Изменения применяются ко всем clients (клиентам с общим кэшем категорий)
+        """
+        interval = self.options.get('categories_refresh_interval', 86400)
+        if not interval:
+            return
+        while True:
+            if self.categories_checked:
+                await asyncio.sleep(interval)
+            self.categories_checked = True
+            if not self.options.get('sd_http_api_endpoint'):
+                continue
+            try:
+                changed = await self.categories_cache.refresh(self.options)
+            except Exception as ex:
+                logging.error('Не удалось обновить категории Sber: %s', ex)
+                continue
+            if changed:
+                for client in clients or [self]:
+                    await client.apply_categories(changed)
+
+    async def apply_categories(self, changed: set[str]):
+        """Переотправляет конфигурацию и состояния, только если изменились используемые категории"""
+        self.categories = self.categories_cache.categories
+        self.converters.set_categories(self.categories)
+        self.categories_version += 1
+        affected = []
+        for entity_id, device in self.devices:
+            if device.enabled and device_model(device) in changed and self.owns(entity_id, device):
+                self.states_cache.pop(entity_id, None)
+                affected.append(entity_id)
+        if not affected:
+            return
+        logging.info('Изменились категории %s устройств, обновляем конфигурацию в Sber', len(affected))
+        await self.queue_read.put({"type": "conf"})
+        for entity_id in affected:
+            await self.queue_read.put({"type": "status", "data": entity_id, "ts": time.monotonic()})
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+
+from metrics import Counter, Histogram
+
+STATUS_BATCH_SIZE = Histogram(
+    'salute_status_batch_size', 'Устройств в пачке up/status', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+STATUS_WAIT_SECONDS = Histogram('salute_status_wait_seconds', 'Ожидание в очереди до отправки up/status')
+STATUS_SUPPRESSED = Counter('salute_status_suppressed_total', 'Устройства, не отправленные из-за неизменного состояния')
+
+class BatchStats:
+    """Статистика пачек up/status: размеры и время ожидания элементов в очереди"""
+
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.max_size = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.suppressed = 0  # устройства, чьё состояние для Sber не изменилось
+
+    def add(self, size: int, waits: list[float], suppressed: int = 0):
+        self.batches += 1
+        self.items += size
+        self.suppressed += suppressed
+        self.max_size = max(self.max_size, size)
+        if waits:
+            self.wait_total += sum(waits)
+            self.wait_max = max(self.wait_max, max(waits))
+
+    def as_dict(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_size": self.items / self.batches if self.batches else 0,
+            "max_size": self.max_size,
+            "avg_wait": self.wait_total / self.items if self.items else 0,
+            "max_wait": self.wait_max,
+            "suppressed": self.suppressed,
+        }
+
+
+class StatusBatcher:
+    """
+    Собирает entity_id из элементов {"type": "status"} очереди в одну пачку.
+    Пачка закрывается по истечении окна window (сек.) с момента первого элемента,
+    при достижении max_size или при появлении в очереди элемента другого типа
+    """
+
+    def __init__(self, queue: asyncio.Queue, window: float, max_size: int):
+        self.queue = queue
+        self.window = window
+        self.max_size = max_size
+        self.stats = BatchStats()
+
+    async def collect(self, first: dict) -> tuple[dict[str, float], set[str], dict | None]:
+        """
+        Возвращает словарь {entity_id: время постановки в очередь}, устройства, которые надо
+        отправить даже без изменений (force, подтверждение команды Sber), и элемент другого типа,
+        на котором сбор был прерван (его надо обработать после отправки пачки)
+        """
+        pending = {}
+        forced = set()
+        self._add(pending, forced, first)
+        deadline = time.monotonic() + self.window
+        while len(pending) < self.max_size:
+            if self.queue.empty():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            if item["type"] != "status":
+                return pending, forced, item
+            self._add(pending, forced, item)
+            self.queue.task_done()
+        return pending, forced, None
+
+    @staticmethod
+    def _add(pending: dict, forced: set, item: dict):
+        # Повторное событие для того же устройства не увеличивает пачку,
+        # время ожидания считаем от самого раннего
+        pending.setdefault(item["data"], item.get("ts", time.monotonic()))
+        if item.get("force"):
+            forced.add(item["data"])
+
+    def done(self, pending: dict[str, float], published: int):
+        now = time.monotonic()
+        waits = [now - ts for ts in pending.values()]
+        self.stats.add(len(pending), waits, suppressed=len(pending) - published)
+        STATUS_BATCH_SIZE.observe(len(pending))
+        STATUS_WAIT_SECONDS.observe(max(waits))
+        STATUS_SUPPRESSED.inc(value=len(pending) - published)
+        logging.debug(
+            "Статус: %s устройств в пачке, отправлено %s, ожидание до %.1f мс",
+            len(pending), published, max(waits) * 1000
+        )
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from http_client import HttpClient
+from utils import json_read, json_write
+
+
+class CategoriesCache:
+    """
+    Категории Sber и их фичи: {категория: [фичи]}.
+    Хранятся в categories_file, рядом в .meta лежат ETag/Last-Modified каждого запроса,
+    чтобы при перепроверке сервер мог ответить 304 без тела
+    """
+
+    def __init__(self, categories_file, http: HttpClient):
+        self.categories_file = categories_file
+        self.meta_file = f'{categories_file}.meta'
+        self.http = http
+        self.categories: dict[str, list] = {}
+        self.validators: dict[str, dict] = {}  # url -> {"etag": ..., "last_modified": ...}
+
+    def load(self) -> bool:
+        """Читает категории с диска, False если файла ещё нет"""
+        if not os.path.exists(self.categories_file):
+            return False
+        self.categories = json_read(self.categories_file)
+        self.validators = json_read(self.meta_file)
+        return bool(self.categories)
+
+    async def refresh(self, options) -> set[str]:
+        """
+        Перепроверяет категории в Sber и заменяет только изменившиеся.
+        Возвращает множество изменившихся (добавленных, удалённых) категорий
+        """
+        previous_validators = dict(self.validators)
+        hds = {'content-type': 'application/json'}
+        auth = aiohttp.BasicAuth(options['sd_mqtt_login'], options['sd_mqtt_password'])
+        categories_url = f"{options['sd_http_api_endpoint']}/v1/mqtt-gate/categories"
+
+        data, validators = await self.http.get_json_conditional(
+            categories_url, self.validators.get(categories_url), headers=hds, auth=auth
+        )
+        self.validators[categories_url] = validators
+        ids = list(self.categories) if data is None else data['categories']
+
+        async def load_features(id):
+            url = f"{categories_url}/{id}/features"
+            logging.debug('Получаем опции для категории: %s', id)
+            # Для новой категории условный запрос не нужен: у нас её нет
+            known = self.validators.get(url) if id in self.categories else None
+            features, validators = await self.http.get_json_conditional(url, known, headers=hds, auth=auth)
+            self.validators[url] = validators
+            return id, None if features is None else features['features']
+
+        # Запросы идут параллельно, количество соединений ограничено пулом HttpClient
+        changed = set()
+        categories = {}
+        for id, features in await asyncio.gather(*map(load_features, ids)):
+            if features is None:
+                features = self.categories[id]
+            elif features != self.categories.get(id):
+                changed.add(id)
+            categories[id] = features
+        changed.update(set(self.categories) - set(categories))
+
+        if changed:
+            logging.info('Изменились категории Sber: %s. Сохраняем в файл.', ', '.join(sorted(changed)))
+            self.categories = categories
+            json_write(self.categories_file, categories)
+        if changed or self.validators != previous_validators:
+            json_write(self.meta_file, self.validators)
+        return changed
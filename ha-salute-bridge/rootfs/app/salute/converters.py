@@ -0,0 +1,170 @@
+"""
+Преобразование состояний HA -> Sber и команд Sber -> HA.
+Для каждой пары (модель, включённые функции устройства) один раз собирается план:
+список функций для конфигурации, кодировщики состояния и декодеры команд.
+Новая модель подключается объявлением кодировщиков/декодеров в ENCODERS/DECODERS
+(или MODEL_ENCODERS/MODEL_DECODERS, если функция у модели передаётся иначе)
+"""
+from typing import Any, Callable
+
+from devices import DeviceModel, DeviceModelsEnum, LightAttrsEnum
+
+
+def state_value(name, data_type, value) -> dict:
+    match data_type:
+        case 'BOOL':
+            return {'key': name, 'value': {'type': 'BOOL', 'bool_value': bool(value)}}
+        case 'INTEGER':
+            return {'key': name, 'value': {'type': 'INTEGER', 'integer_value': int(value)}}
+        case 'ENUM':
+            return {'key': name, 'value': {'type': 'ENUM', 'enum_value': value}}
+
+
+# HA -> Sber: функция Sber -> кодировщик состояния, None - значение не передаём
+
+def encode_online(device: DeviceModel):
+    return state_value("online", "BOOL", device.state != "unavailable")
+
+
+def encode_on_off(device: DeviceModel):
+    return state_value("on_off", "BOOL", device.state == "on")
+
+
+def encode_light_brightness(device: DeviceModel):
+    val = (device.attributes or {}).get("brightness")
+    if val is None:  # Включено, но нету - не передаём
+        return None
+    val = round(val / 2.55 * 10)  # приводим из 1-255 к диапозону 50-1000
+    return state_value("light_brightness", "INTEGER", min(max(val, 50), 1000))
+
+
+def encode_button_event(device: DeviceModel):
+    return state_value("button_event", "ENUM", "click" if device.state == "on" else "double_click")
+
+
+def encode_temperature(device: DeviceModel):
+    try:
+        val = float(device.state)
+    except (TypeError, ValueError):
+        val = 0
+    return state_value("temperature", "INTEGER", val * 10)
+
+
+ENCODERS: dict[str, Callable[[DeviceModel], dict | None]] = {
+    "online": encode_online,
+    "on_off": encode_on_off,
+    "light_brightness": encode_light_brightness,
+    "button_event": encode_button_event,
+    "temperature": encode_temperature,
+}
+MODEL_ENCODERS: dict[tuple[DeviceModelsEnum, str], Callable[[DeviceModel], dict | None]] = {}
+
+
+# Sber -> HA: функция Sber -> изменения для Devices.update
+
+def decode_on_off(value, device: DeviceModel):
+    return {"state": "on" if value else "off"}
+
+
+def decode_light_brightness(value, device: DeviceModel):
+    value = round(value / 10 * 2.55)  # приводим из 50-1000 к диапозону 1-255
+    return {"attributes": {**(device.attributes or {}), "brightness": value}}
+
+
+def decode_button_event(value, device: DeviceModel):
+    return {"state": "on" if value == "click" else "off"}
+
+
+DECODERS: dict[str, Callable[[Any, DeviceModel], dict]] = {
+    "on_off": decode_on_off,
+    "light_brightness": decode_light_brightness,
+    "button_event": decode_button_event,
+}
+MODEL_DECODERS: dict[tuple[DeviceModelsEnum, str], Callable[[Any, DeviceModel], dict]] = {}
+
+VALUE_READERS = {
+    'BOOL': lambda value: value.get('bool_value', False),
+    'INTEGER': lambda value: int(value.get('integer_value', 0)),
+    'ENUM': lambda value: value.get('enum_value', ''),
+}
+
+# Функция Sber, которую включает функция устройства с другим названием
+FEATURE_FLAGS = {"light_brightness": LightAttrsEnum.brightness}
+
+
+def device_model(device: DeviceModel):
+    """Категория Sber устройства, None - устройство в Sber не передаётся"""
+    if device.model is None and device.category == "light":
+        return DeviceModelsEnum.light
+    return device.model
+
+
+class ConverterPlan:
+    __slots__ = ("model", "features", "encoders", "decoders")
+
+    def __init__(self, model, features: list[str], encoders: list[Callable], decoders: dict[str, Callable]):
+        self.model = model
+        self.features = features  # функции для документа конфигурации
+        self.encoders = encoders
+        self.decoders = decoders
+
+    def states(self, device: DeviceModel, confirmed: bool = True) -> list[dict]:
+        states = []
+        for encode in self.encoders:
+            if (state := encode(device)) is not None:
+                states.append(state)
+        if not confirmed:
+            # Значения из devices.json, но HA их ещё не подтвердил: устройство не в сети
+            states = [state_value("online", "BOOL", False) if state['key'] == "online" else state for state in states]
+        return states
+
+    def command(self, device: DeviceModel, states: list[dict]) -> dict:
+        # Command: [{'key': 'on_off', 'value': {'type': 'BOOL'}}]
+        update = {}
+        for state in states:
+            decode = self.decoders.get(state['key'])
+            if decode is None:
+                continue
+            value = state['value']
+            read = VALUE_READERS.get(value.get('type', ''))
+            update.update(decode(read(value) if read else '', device))
+        return update
+
+
+class Converters:
+    """Кэш планов, сбрасывается при смене категорий; смена функций устройства даёт другой ключ"""
+
+    def __init__(self):
+        self.categories: dict[str, list] = {}
+        self._plans: dict[tuple, ConverterPlan] = {}
+
+    def set_categories(self, categories: dict[str, list]):
+        self.categories = categories
+        self._plans.clear()
+
+    def plan(self, device: DeviceModel) -> ConverterPlan | None:
+        model = device_model(device)
+        if model is None:
+            return None
+        key = (model, tuple(device.features or ()))
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self.compile(*key)
+        return plan
+
+    def compile(self, model, features: tuple) -> ConverterPlan:
+        enabled = set(features)
+        names = []
+        for ft in self.categories.get(model) or []:
+            name = ft['name']
+            # Будем выдавать список из доступных фич для каждого типа в вебе и
+            # юзер сам будет включать их для каждого элемента
+            if ft.get('required', False) or FEATURE_FLAGS.get(name, name) in enabled:
+                names.append(name)
+        encoders = []
+        for name in names:
+            if (encode := MODEL_ENCODERS.get((model, name), ENCODERS.get(name))) is not None:
+                encoders.append(encode)
+        decoders = {name: MODEL_DECODERS.get((model, name), decode) for name, decode in DECODERS.items()}
+        decoders.update({name: decode for (m, name), decode in MODEL_DECODERS.items() if m == model})
+        return ConverterPlan(model, names, encoders, decoders)
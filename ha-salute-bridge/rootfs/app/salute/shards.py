@@ -0,0 +1,95 @@
+"""
+Распределение устройств по учётным записям Sber (шардам).
+У каждого шарда своё MQTT-соединение, очередь и документ конфигурации,
+соединение с HA и реестр устройств общие
+"""
+import logging
+import time
+import zlib
+
+from devices import Devices, DeviceModel
+from queues import CoalescingQueue
+
+
+def accounts_from_options(options) -> list[dict]:
+    """Основная учётная запись sd_mqtt_login/sd_mqtt_password и дополнительные из sd_mqtt_accounts"""
+    accounts = [{"login": options['sd_mqtt_login'], "password": options['sd_mqtt_password']}]
+    for account in options.get('sd_mqtt_accounts') or []:
+        if any(account['login'] == known['login'] for known in accounts):
+            logging.warning('Учётная запись Sber %s указана несколько раз', account['login'])
+            continue
+        accounts.append({"login": account['login'], "password": account['password']})
+    return accounts
+
+
+class ShardMap:
+    """
+    Шард устройства: явно заданный в DeviceModel.shard (если такая учётная запись есть),
+    иначе по хэшу entity_id. Хэширование rendezvous: при добавлении учётной записи
+    переезжает только часть устройств, а не почти все, как при crc32 % n
+    """
+
+    def __init__(self, logins: list[str]):
+        self.logins = logins
+        self._hashed: dict[str, str] = {}
+
+    def shard(self, entity_id: str, device: DeviceModel | None = None) -> str:
+        if len(self.logins) == 1:
+            return self.logins[0]
+        if device is not None and device.shard in self.logins:
+            return device.shard
+        login = self._hashed.get(entity_id)
+        if login is None:
+            login = self._hashed[entity_id] = max(
+                self.logins, key=lambda login: zlib.crc32(f"{login}/{entity_id}".encode())
+            )
+        return login
+
+
+class ShardedQueue:
+    """
+    Для HA и веб-интерфейса выглядит как одна очередь в Sber:
+    status уходит в очередь шарда устройства, resync делится по шардам, остальное (conf) - во все
+    """
+
+    def __init__(self, queues: dict[str, CoalescingQueue], shards: ShardMap, devices: Devices):
+        self.queues = queues
+        self.shards = shards
+        self.devices = devices
+        # entity_id -> шард, которому устройство принадлежало при последнем изменении конфигурации
+        self.owners = {entity_id: self.shard_of(entity_id) for entity_id in devices.keys()}
+        devices.subscribe(self.on_device_update)
+
+    def shard_of(self, entity_id: str) -> str:
+        return self.shards.shard(entity_id, self.devices.get(entity_id))
+
+    def on_device_update(self, entity_id: str, device: DeviceModel, config: bool):
+        """
+        Устройство переехало в другой шард (сменился DeviceModel.shard): новому владельцу
+        нужна конфигурация с ним и его состояние, само оно в очередь не попадёт до события из HA
+        """
+        if not config:
+            return
+        login = self.shards.shard(entity_id, device)
+        previous = self.owners.get(entity_id)
+        self.owners[entity_id] = login
+        if previous is None or previous == login:
+            return
+        logging.info('Устройство %s переехало из шарда %s в %s', entity_id, previous, login)
+        queue = self.queues[login]
+        queue.put_nowait({"type": "conf"})
+        queue.put_nowait({"type": "status", "data": entity_id, "ts": time.monotonic()})
+
+    async def put(self, item):
+        match item["type"]:
+            case "status":
+                await self.queues[self.shard_of(item["data"])].put(item)
+            case "resync" if item["data"]:
+                by_shard: dict[str, list[str]] = {}
+                for entity_id in item["data"]:
+                    by_shard.setdefault(self.shard_of(entity_id), []).append(entity_id)
+                for login, entity_ids in by_shard.items():
+                    await self.queues[login].put({**item, "data": tuple(entity_ids)})
+            case _:
+                for queue in self.queues.values():
+                    await queue.put(item)
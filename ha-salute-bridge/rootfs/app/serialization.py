@@ -0,0 +1,42 @@
+"""
+Единая точка (де)сериализации JSON.
+Если установлен orjson, кодируем и разбираем им, иначе стандартным json.
+Вывод у обоих вариантов одинаковый: UTF-8 без экранирования, без пробелов,
+ключи по умолчанию отсортированы
+"""
+import json
+from functools import lru_cache
+from typing import Any
+
+from pydantic import TypeAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+if orjson is not None:
+    def dumps_bytes(obj: Any, sort_keys: bool = True) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+    def dumps(obj: Any, sort_keys: bool = True) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(obj: Any, sort_keys: bool = True) -> str:
+        return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys, separators=(',', ':'))
+
+    def dumps_bytes(obj: Any, sort_keys: bool = True) -> bytes:
+        return dumps(obj, sort_keys).encode('utf-8')
+
+    def loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+
+@lru_cache(maxsize=None)
+def type_adapter(tp) -> TypeAdapter:
+    """Построение TypeAdapter дорогое (схема собирается заново), поэтому один на тип"""
+    return TypeAdapter(tp)
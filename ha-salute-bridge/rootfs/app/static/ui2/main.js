@@ -4,6 +4,7 @@ function Init() {
     AddBlok('<button id="DB_delete" onclick="RunCmd(this.id)">   &#128465; Удалить базу устройств</button>')
     AddBlok('<h2>Устройства:</h2>', 'alert')
     apiGet()
+    StreamDevices()
 }
 
 function AddBlok(str, CN) {
@@ -45,18 +46,19 @@ function ChangeFeatures(d) {
     apiSend(s, '/api/v2/device/features');
 }
 
-function UpdateDeviceList(d) {
-    let f = {
-        'enabled': 'Включено',
-        'home': 'Дом',
-        'room': 'Комната',
-        'id': 'ID',
-        'name': 'Имя',
-        'model': 'Модель',
-        'state': 'Состояние',
-        'attributes': 'Атрибуты',
-        'features': 'Функции устройства'
-    }
+const DEVICE_FIELDS = {
+    'enabled': 'Включено',
+    'home': 'Дом',
+    'room': 'Комната',
+    'id': 'ID',
+    'name': 'Имя',
+    'model': 'Модель',
+    'state': 'Состояние',
+    'attributes': 'Атрибуты',
+    'features': 'Функции устройства'
+}
+
+function FillDeviceRow(tbody_row, i, dev) {
     // {
     //   "entity_id": "vykliuchatel_gostinnaia_left",
     //   "category": "light",
@@ -66,6 +68,46 @@ function UpdateDeviceList(d) {
     //   "model": "light",
     //   "attributes": null
     // },
+    tbody_row.replaceChildren();
+    tbody_row.dataset.id = i;
+    for (let k in DEVICE_FIELDS) {
+        let el = document.createElement('td');
+        let r = '';
+        switch (k) {
+            case 'id':
+                r = dev["category"] + "." + dev["entity_id"];
+                break;
+            case 'enabled':
+                if (dev[k]) {
+                    r = '<input type="checkbox" data-id="' + i + '" checked onchange=ChangeDev(this)>';
+                } else {
+                    r = '<input type="checkbox" data-id="' + i + '" onchange=ChangeDev(this)>';
+                }
+                break;
+            case 'attributes':
+                if (dev['attributes']) {
+                    r = JSON.stringify(dev['attributes']);
+                }
+                break;
+            case 'features':
+                let features = dev["features"];
+                if (features == null) features = [];
+                if (dev["model"] === "light") {
+                    r = '<input type="checkbox" data-id="' + i +
+                        '" data-feature="brightness" '+ (features.includes("brightness") ? "checked" : "") +
+                        ' onchange=ChangeFeatures(this)><label for="' + i +'">brightness</label>';
+                }
+                break;
+            default:
+                r = dev[k];
+                break;
+        }
+        el.innerHTML = r;
+        tbody_row.append(el)
+    }
+}
+
+function UpdateDeviceList(d) {
     let table = document.getElementById('devices');
     if (!table) {
         table = document.createElement('table');
@@ -73,66 +115,63 @@ function UpdateDeviceList(d) {
         let pel = document.getElementById('root');
         pel.append(table);
     }
+    table.replaceChildren();
 
     let thead = document.createElement('thead');
     let tbody = document.createElement('tbody');
 
     let thead_row = document.createElement('tr');
-    for (let k in f) {
+    for (let k in DEVICE_FIELDS) {
         let el = document.createElement('th');
-        el.innerHTML = f[k];
+        el.innerHTML = DEVICE_FIELDS[k];
         thead_row.append(el)
     }
     thead.appendChild(thead_row);
 
     for (let i in d) {
         let tbody_row = document.createElement('tr');
-        for (let k in f) {
-            let el = document.createElement('td');
-            let r = '';
-            switch (k) {
-                case 'id':
-                    r = d[i]["category"] + "." + d[i]["entity_id"];
-                    break;
-                case 'enabled':
-                    if (d[i][k]) {
-                        r = '<input type="checkbox" data-id="' + i + '" checked onchange=ChangeDev(this)>';
-                    } else {
-                        r = '<input type="checkbox" data-id="' + i + '" onchange=ChangeDev(this)>';
-                    }
-                    break;
-                case 'attributes':
-                    if (d[i]['attributes']) {
-                        r = JSON.stringify(d[i]['attributes']);
-                    }
-                    break;
-                case 'features':
-                    let features = d[i]["features"];
-                    if (features == null) features = [];
-                    if (d[i]["model"] === "light") {
-                        r = '<input type="checkbox" data-id="' + i +
-                            '" data-feature="brightness" '+ (features.includes("brightness") ? "checked" : "") +
-                            ' onchange=ChangeFeatures(this)><label for="' + i +'">brightness</label>';
-                    }
-                    break;
-                default:
-                    r = d[i][k];
-                    break;
-            }
-            el.innerHTML = r;
-            tbody_row.append(el)
-        }
+        FillDeviceRow(tbody_row, i, d[i]);
         tbody.appendChild(tbody_row);
     }
 
 
     table.appendChild(thead);
     table.appendChild(tbody);
-//   document.getElementById('body').appendChild(table);
-//   for (let k in d['devices']){
-//      let v=d['devices'][k];
-//      AddBlok(v['id']+':'+v['name']);
-//   }
+}
+
+function UpdateDevice(i, dev) {
+    let table = document.getElementById('devices');
+    if (!table) {
+        return;
+    }
+    let tbody_row = table.querySelector('tr[data-id="' + CSS.escape(i) + '"]');
+    if (!tbody_row) {
+        tbody_row = document.createElement('tr');
+        table.tBodies[0].appendChild(tbody_row);
+    }
+    FillDeviceRow(tbody_row, i, dev);
+}
+
+function StreamDevices() {
+    // Изменения приходят с сервера по мере появления, список целиком перечитываем только при потерях
+    let source = new EventSource('/api/v2/devices/stream');
+    let onDevice = function (event) {
+        let data = JSON.parse(event.data);
+        UpdateDevice(data['id'], data['device']);
+    };
+    source.addEventListener('state', onDevice);
+    source.addEventListener('config', onDevice);
+    source.addEventListener('resync', function () {
+        apiGet();
+    });
+    let connected = false;
+    source.addEventListener('hello', function () {
+        // После переподключения изменения за время разрыва потеряны
+        if (connected) {
+            apiGet();
+        }
+        connected = true;
+    });
 }
 
 function Res_Processing(Res) {
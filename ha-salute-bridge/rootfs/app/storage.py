@@ -0,0 +1,96 @@
+import asyncio
+import logging as log
+import os
+from typing import Callable, Iterator
+
+from serialization import dumps, loads
+
+
+class WriteBehind:
+    """
+    Отложенная запись на диск.
+    schedule(prepare) копит вызовы в течение delay секунд, затем на цикле событий
+    вызывается последний prepare(): он быстро снимает данные и возвращает функцию,
+    которая их сериализует и пишет уже в отдельном потоке.
+    Без запущенного цикла событий запись выполняется сразу
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._prepare: Callable[[], Callable[[], None]] | None = None
+        self._task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+
+    def schedule(self, prepare: Callable[[], Callable[[], None]]):
+        self._prepare = prepare
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._prepare = None
+            prepare()()
+            return
+        if self._task is None or self._task.done():
+            self._wake.clear()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        # Пока ждали или писали, могли прийти новые изменения - пишем ещё раз
+        while self._prepare is not None:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.delay)
+            except TimeoutError:
+                pass
+            prepare, self._prepare = self._prepare, None
+            try:
+                await asyncio.to_thread(prepare())
+            except Exception:
+                log.exception('Ошибка отложенной записи на диск')
+
+    async def flush(self):
+        """Записать отложенные изменения немедленно (например, при остановке)"""
+        if self._task is not None and not self._task.done():
+            self._wake.set()
+            await self._task
+
+
+class Journal:
+    """Журнал изменений: одна json-запись на строку, только дозапись в конец"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.size = 0  # записей с последнего сжатия
+
+    def append(self, records: list[dict]):
+        lines = ''.join(dumps(r, sort_keys=False) + '\n' for r in records)
+        with open(self.fname, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(records)
+
+    def read(self) -> Iterator[dict]:
+        try:
+            with open(self.fname, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            # Недописанная при сбое последняя строка: отрезаем, иначе следующая запись склеится с ней
+            log.warning('Отбрасываем недописанную запись журнала %s', self.fname)
+            with open(self.fname, 'r+b') as f:
+                f.truncate(complete)
+        for line in data[:complete].splitlines():
+            if not line.strip():
+                continue
+            try:
+                yield loads(line)
+            except ValueError:
+                log.warning('Пропускаем повреждённую запись журнала %s', self.fname)
+
+    def clear(self):
+        try:
+            os.remove(self.fname)
+        except FileNotFoundError:
+            pass
+        self.size = 0
@@ -0,0 +1,92 @@
+"""
+Трассировка команд Sber: от получения в on_message_cmd до отправки подтверждающего up/status
+"""
+import logging
+import time
+from collections import deque
+from itertools import count
+
+# Этапы в обычном порядке прохождения (ответ HA на call_service может прийти и после state_changed)
+STAGES = ("queued", "dispatched", "acked", "state_changed", "published")
+# От какого этапа считается длительность каждого этапа (None - от получения команды)
+PREVIOUS = {
+    "queued": None,
+    "dispatched": "queued",
+    "acked": "dispatched",
+    "state_changed": "dispatched",
+    "published": "state_changed",
+}
+
+
+class Trace:
+    __slots__ = ("id", "entity_id", "start", "stages")
+
+    def __init__(self, trace_id: int, entity_id: str):
+        self.id = trace_id
+        self.entity_id = entity_id
+        self.start = time.monotonic()
+        self.stages: dict[str, float] = {}  # этап -> секунд от получения команды
+
+    def as_dict(self):
+        return {"id": self.id, "entity_id": self.entity_id, "stages": self.stages}
+
+
+class CommandTracer:
+    def __init__(self, size: int = 500):
+        self.completed: deque[Trace] = deque(maxlen=size)
+        self._active: dict[str, Trace] = {}  # по одной незавершённой трассе на устройство
+        self._ids = count(1)
+
+    def start(self, entity_id: str) -> int:
+        if (previous := self._active.pop(entity_id, None)) is not None:
+            # Новая команда до подтверждения предыдущей: сохраняем её незавершённой
+            self.completed.append(previous)
+        trace = self._active[entity_id] = Trace(next(self._ids), entity_id)
+        return trace.id
+
+    def mark(self, entity_id: str, stage: str):
+        trace = self._active.get(entity_id)
+        if trace is None or stage in trace.stages:
+            return
+        if stage == "published" and "state_changed" not in trace.stages:
+            # Статус ушёл по другой причине, подтверждение ещё впереди
+            return
+        trace.stages[stage] = time.monotonic() - trace.start
+        if stage == STAGES[-1]:
+            del self._active[entity_id]
+            self.completed.append(trace)
+            logging.debug('Команда #%s для %s: %s', trace.id, entity_id, trace.stages)
+
+    def report(self, recent: int = 20):
+        """Перцентили времени от получения команды до каждого этапа и между соседними этапами"""
+        traces = list(self.completed)
+        total = {stage: [] for stage in STAGES}
+        delta = {stage: [] for stage in STAGES}
+        for trace in traces:
+            for stage, value in trace.stages.items():
+                total[stage].append(value)
+                if (previous := PREVIOUS[stage]) is None:
+                    delta[stage].append(value)
+                elif previous in trace.stages:
+                    delta[stage].append(value - trace.stages[previous])
+        return {
+            "count": len(traces),
+            "complete": len(total[STAGES[-1]]),
+            "since_received": {stage: percentiles(values) for stage, values in total.items()},
+            "stage": {stage: percentiles(values) for stage, values in delta.items()},
+            "recent": [trace.as_dict() for trace in traces[-recent:]],
+        }
+
+
+def percentiles(values: list[float]):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {"p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": values[-1]}
+
+
+TRACER = CommandTracer()
@@ -1,12 +1,15 @@
-import json
 import logging as log
+import os
+import tempfile
+
+from serialization import dumps_bytes, loads
 
 
 def json_read(fname):
     try:
-        with open(fname,'r', encoding='utf-8') as f:
+        with open(fname, 'rb') as f:
             try:
-                r = json.loads(f.read())
+                r = loads(f.read())
             except:
                 r = {}
                 log.error('!!! Неверная конфигурация в файле: %s', f)
@@ -15,5 +18,29 @@ def json_read(fname):
         return {}
 
 def json_write(fname, data):
-    with open(fname, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, sort_keys=True)
\ No newline at end of file
+    write_atomic(fname, dumps_bytes(data))
+
+
+# umask процесса: узнать его можно только сменив, поэтому один раз при импорте, а не в потоках записи
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def write_atomic(fname, data: bytes):
+    """Пишем во временный файл рядом и подменяем им целевой, чтобы не оставить его обрезанным"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), prefix=os.path.basename(fname), suffix='.tmp')
+    try:
+        # mkstemp создаёт файл с правами 0600: сохраняем права прежнего файла, для нового - как у open()
+        try:
+            mode = os.stat(fname).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -1,17 +1,28 @@
+import asyncio
 import logging
+import zlib
+from bisect import bisect_right
 
-from fastapi import APIRouter, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 
-from models.api import DevicesEditModel, FeatureEditModel
+from metrics import REGISTRY
+from devices import DeviceModel
+from models.api import DevicesBatchModel, DevicesEditModel, FeatureEditModel
+from serialization import dumps_bytes, type_adapter
+from tracing import TRACER
 
 router = APIRouter()
 
 templates = Jinja2Templates(directory="../app/templates")
 
-async def send_mqtt_conf(mqtt_queue):
-    await mqtt_queue.put({"type": "conf"})
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse с кодированием через serialization (orjson, если установлен)"""
+
+    def render(self, content) -> bytes:
+        return dumps_bytes(content, sort_keys=False)
 
 
 @router.get("/")
@@ -21,10 +32,96 @@ async def main(request: Request):
     )
 
 
+def devices_etag(devices, selected, query: str) -> str:
+    """
+    ETag самой выдачи: устройства в ней и версии их состояний плюс config_version
+    (имя, включение, модель, функции, а с ними и состав выборки) и параметры запроса.
+    Изменения состояний устройств вне страницы или фильтра его не меняют
+    """
+    digest = zlib.crc32(query.encode())
+    for key in selected:
+        digest = zlib.crc32(f"{key}:{devices.version(key)},".encode(), digest)
+    return f'"{devices.config_version}-{digest:08x}"'
+
+
+def device_matches(device: DeviceModel, category, enabled, name) -> bool:
+    if category is not None and device.category != category:
+        return False
+    if enabled is not None and bool(device.enabled) != enabled:
+        return False
+    if name is not None and name not in (device.name or '').casefold():
+        return False
+    return True
+
+
 @router.get("/api/v2/devices", response_class=JSONResponse)
-async def devices_list(request: Request):
-     data = request.state.devices.as_dict()
-     return JSONResponse(data)
+async def devices_list(
+        request: Request,
+        category: str | None = None,
+        enabled: bool | None = None,
+        name: str | None = None,
+        cursor: str | None = None,
+        limit: int | None = Query(None, ge=1),
+):
+    """
+    Список устройств {entity_id: устройство}.
+    Без параметров - весь реестр в порядке добавления, как раньше.
+    category/enabled/name (подстрока без учёта регистра) фильтруют на сервере,
+    limit включает постраничную выдачу по алфавиту entity_id:
+    следующая страница запрашивается с cursor из заголовка X-Next-Cursor
+    """
+    devices = request.state.devices
+    headers = {"Cache-Control": "no-cache"}
+    if name is not None:
+        name = name.casefold()
+    if limit is None and cursor is None:
+        keys = devices.keys()
+    else:
+        keys = devices.sorted_keys()
+        if cursor is not None:
+            keys = keys[bisect_right(keys, cursor):]
+
+    selected = {}
+    for key in keys:
+        device = devices[key]
+        if not device_matches(device, category, enabled, name):
+            continue
+        if limit is not None and len(selected) == limit:
+            headers["X-Next-Cursor"] = last_key
+            break
+        selected[key] = device
+        last_key = key
+
+    # Выборка дешёвая, дорогие сериализация и передача - только если выдача изменилась
+    etag = headers["ETag"] = devices_etag(devices, selected, str(request.query_params))
+    if etag in {tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")}:
+        return Response(status_code=304, headers=headers)
+
+    # Записи неизменяемые, поэтому сериализовать выборку можно вне event loop
+    body = await asyncio.to_thread(type_adapter(dict[str, DeviceModel]).dump_json, selected)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@router.get("/api/v2/devices/stream")
+async def devices_stream(request: Request):
+    """Изменения устройств в виде SSE: события state и config с записью устройства, resync при потерях"""
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        # GZipMiddleware буферизует поток, с заданной кодировкой ответ проходит как есть
+        "Content-Encoding": "identity",
+    }
+    return StreamingResponse(request.state.device_stream.events(), media_type="text/event-stream", headers=headers)
+
+
+@router.get("/api/v2/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/api/v2/traces", response_class=FastJSONResponse)
+async def traces():
+    return FastJSONResponse(TRACER.report())
 
 
 @router.post("/api/v2/devices")
@@ -34,23 +131,50 @@ async def update_device(request: Request, devices: DevicesEditModel):
         for entity_id, prop in i.items():
             logging.debug('%s: %s', entity_id, prop)
             request.state.devices.update(entity_id, prop)
-    await send_mqtt_conf(request.state.mqtt_queue)
+    # Серия кликов в интерфейсе - одна отправка конфигурации в Sber
+    request.state.config_publisher.schedule()
     request.state.devices.save()
 
 
+@router.post("/api/v2/devices/batch")
+async def update_devices_batch(request: Request, batch: DevicesBatchModel):
+    """
+    Пакетное изменение устройств: все изменения проверяются заранее и применяются
+    вместе (между ними нет await), затем одна запись на диск и сразу одна отправка конфигурации
+    """
+    devices = request.state.devices
+    unknown = [entity_id for entity_id in batch.devices if devices.get(entity_id) is None]
+    if unknown:
+        raise HTTPException(status_code=404, detail={"unknown": unknown})
+    logins = request.state.shards.logins
+    bad_shards = sorted({change.shard for change in batch.devices.values() if change.shard not in (None, *logins)})
+    if bad_shards:
+        raise HTTPException(status_code=422, detail={"unknown_shards": bad_shards})
+    logging.debug('Пакетное изменение %s устройств', len(batch.devices))
+    version = devices.registry_version
+    for entity_id, change in batch.devices.items():
+        devices.update(entity_id, change.model_dump(exclude_unset=True))
+    changed = devices.registry_version != version
+    if changed:
+        # Конфигурация уходит сразу (вместе с отложенными правками), а не через config_publish_delay
+        request.state.config_publisher.schedule()
+        await request.state.config_publisher.flush()
+        devices.save()
+    return {"changed": changed}
+
+
 @router.post("/api/v2/device/features")
 async def update_device(request: Request, feature: FeatureEditModel):
     logging.debug('Меняем данные для %s', feature)
     if feature.entity_id in request.state.devices.keys():
         device = request.state.devices[feature.entity_id]
-        if device.features is None:
-            device.features = []
+        features = list(device.features or [])
         if feature.state:
-            if feature.feature not in device.features:
-                device.features.append(feature.feature)
+            if feature.feature not in features:
+                features.append(feature.feature)
         else:
-            if feature.feature in device.features:
-                device.features.remove(feature.feature)
-        request.state.devices.update(feature.entity_id, device)
-        await send_mqtt_conf(request.state.mqtt_queue)
+            if feature.feature in features:
+                features.remove(feature.feature)
+        request.state.devices.update(feature.entity_id, {"features": features})
+        request.state.config_publisher.schedule()
         request.state.devices.save()
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Поток изменений устройств для веб-интерфейса (Server-Sent Events).
+Каждый подписчик получает свою ограниченную очередь с объединением по устройству:
+в очереди лежит только ключ, а запись берётся из реестра в момент отправки,
+поэтому медленная вкладка получает последнее состояние, а не всю историю,
+и никогда не задерживает Devices.update
+"""
+import asyncio
+
+from devices import Devices
+from queues import CoalescingQueue, OverflowPolicy
+from serialization import dumps
+
+
+class DeviceStream:
+    def __init__(self, devices: Devices, buffer_size: int = 256, keepalive: float = 15):
+        self.devices = devices
+        self.buffer_size = buffer_size
+        self.keepalive = keepalive
+        self.subscribers: set[CoalescingQueue] = set()
+        devices.subscribe(self.on_update)
+
+    def on_update(self, key, device, config):
+        item = ("config" if config else "state", key)
+        for queue in self.subscribers:
+            queue.put_nowait(item)
+
+    def subscribe(self) -> CoalescingQueue:
+        # Ключ - сам элемент: изменения состояния и конфигурации устройства объединяются раздельно
+        queue = CoalescingQueue(
+            key=lambda item: item, maxsize=self.buffer_size, overflow=OverflowPolicy.drop_oldest, name="web_stream"
+        )
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: CoalescingQueue):
+        self.subscribers.discard(queue)
+
+    @staticmethod
+    def format(event: str, data: str) -> str:
+        return f"event: {event}\ndata: {data}\n\n"
+
+    def device_event(self, kind: str, key: str) -> str:
+        device = self.devices[key]
+        return self.format(kind, f'{{"id":{dumps(key)},"device":{device.model_dump_json()}}}')
+
+    async def events(self):
+        queue = self.subscribe()
+        dropped = 0
+        try:
+            yield self.format("hello", dumps({"registry_version": self.devices.registry_version}))
+            while True:
+                try:
+                    kind, key = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                queue.task_done()
+                if queue.dropped != dropped:
+                    # Часть изменений вытеснена - клиенту нужно перечитать список целиком
+                    dropped = queue.dropped
+                    yield self.format("resync", dumps({"registry_version": self.devices.registry_version}))
+                yield self.device_event(kind, key)
+        finally:
+            self.unsubscribe(queue)
@@ -0,0 +1,185 @@
+import asyncio
+import json
+from urllib.parse import urlencode
+
+import pytest
+from fastapi import FastAPI
+
+from devices import DeviceModel, Devices
+from queues import CoalescingQueue, Debounce
+from salute.shards import ShardMap
+from web.routes import router
+
+ENTITIES = ["light.d", "switch.a", "light.b", "light.c", "switch.e"]
+
+
+@pytest.fixture
+def devices(tmp_path):
+    devices = Devices(str(tmp_path / 'devices.json'))
+    for key in ENTITIES:
+        category, entity_id = key.split('.')
+        devices.update(key, DeviceModel(
+            entity_id=entity_id, category=category, name=f"Устройство {entity_id.upper()}",
+            state="off", enabled=category == "light",
+        ))
+    return devices
+
+
+async def call(
+        state: dict, method: str, path: str, params: dict | None = None, headers: dict | None = None,
+        body: bytes = b"",
+) -> tuple[int, dict, bytes]:
+    """Запрос к роутеру напрямую через ASGI, state - как из lifespan"""
+    app = FastAPI()
+    app.include_router(router)
+    query = urlencode(params or {})
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+        "state": state,
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    content = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], response_headers, content
+
+
+def get(devices, params: dict | None = None, headers: dict | None = None) -> tuple[int, dict, bytes]:
+    return asyncio.run(call({"devices": devices}, "GET", "/api/v2/devices", params, headers))
+
+
+def test_full_list_in_insertion_order(devices):
+    status, headers, body = get(devices)
+    assert status == 200
+    assert list(json.loads(body)) == ENTITIES
+    assert "x-next-cursor" not in headers
+    assert headers["etag"]
+
+
+def test_cursor_pages_cover_sorted_keys(devices):
+    seen = []
+    params = {"limit": 2}
+    while True:
+        status, headers, body = get(devices, params)
+        assert status == 200
+        page = list(json.loads(body))
+        assert len(page) <= 2
+        seen += page
+        if "x-next-cursor" not in headers:
+            break
+        assert headers["x-next-cursor"] == page[-1]
+        params = {"limit": 2, "cursor": headers["x-next-cursor"]}
+    assert seen == sorted(ENTITIES)
+
+
+def test_filters(devices):
+    _, _, body = get(devices, {"enabled": "true"})
+    assert list(json.loads(body)) == ["light.d", "light.b", "light.c"]
+    _, _, body = get(devices, {"category": "switch", "limit": 10})
+    assert list(json.loads(body)) == ["switch.a", "switch.e"]
+    _, _, body = get(devices, {"name": "устройство b"})
+    assert list(json.loads(body)) == ["light.b"]
+
+
+def test_not_modified(devices):
+    _, headers, _ = get(devices, {"limit": 2})
+    etag = headers["etag"]
+    status, headers, body = get(devices, {"limit": 2}, {"If-None-Match": etag})
+    assert status == 304
+    assert body == b""
+    assert headers["etag"] == etag
+    # Слабый и список валидаторов тоже подходят
+    status, _, _ = get(devices, {"limit": 2}, {"If-None-Match": f'"other", W/{etag}'})
+    assert status == 304
+
+
+def test_etag_follows_the_returned_page(devices):
+    _, headers, _ = get(devices, {"limit": 2})
+    etag = headers["etag"]
+    # Состояние устройства вне страницы выдачу не меняет
+    devices.change_state("switch.e", "on")
+    status, _, _ = get(devices, {"limit": 2}, {"If-None-Match": etag})
+    assert status == 304
+    # Состояние устройства на странице - меняет
+    devices.change_state("light.b", "on")
+    status, headers, body = get(devices, {"limit": 2}, {"If-None-Match": etag})
+    assert status == 200
+    assert headers["etag"] != etag
+    assert json.loads(body)["light.b"]["state"] == "on"
+
+
+def test_etag_depends_on_query_and_config(devices):
+    _, headers, _ = get(devices, {"limit": 2})
+    etag = headers["etag"]
+    _, other, _ = get(devices, {"limit": 3})
+    assert other["etag"] != etag
+    devices.update("light.b", {"name": "Новое имя"})
+    status, _, _ = get(devices, {"limit": 2}, {"If-None-Match": etag})
+    assert status == 200
+
+
+def test_batch_queues_config_at_once(devices):
+    async def scenario():
+        queue = CoalescingQueue(key=lambda item: (item["type"], item.get("data")))
+        state = {
+            "devices": devices,
+            "shards": ShardMap(["login"]),
+            "config_publisher": Debounce(lambda: queue.put({"type": "conf"}), delay=10),
+        }
+        body = json.dumps({"devices": {"switch.a": {"enabled": True}, "light.b": {"name": "Б"}}}).encode()
+        status, _, content = await call(
+            state, "POST", "/api/v2/devices/batch", headers={"Content-Type": "application/json"}, body=body,
+        )
+        assert status == 200
+        assert json.loads(content) == {"changed": True}
+        # Не через config_publish_delay, а сразу после применения пакета
+        assert queue.get_nowait() == {"type": "conf"}
+        assert devices.get("switch.a").enabled is True
+        assert devices.get("light.b").name == "Б"
+
+        status, _, content = await call(
+            state, "POST", "/api/v2/devices/batch", headers={"Content-Type": "application/json"}, body=body,
+        )
+        assert json.loads(content) == {"changed": False}
+        assert queue.empty()
+
+    asyncio.run(scenario())
+
+
+def test_batch_is_all_or_nothing(devices):
+    async def scenario():
+        state = {"devices": devices, "shards": ShardMap(["login"])}
+        version = devices.registry_version
+        body = json.dumps({"devices": {"switch.a": {"enabled": True}, "light.x": {"enabled": True}}}).encode()
+        status, _, content = await call(
+            state, "POST", "/api/v2/devices/batch", headers={"Content-Type": "application/json"}, body=body,
+        )
+        assert status == 404
+        assert json.loads(content)["detail"] == {"unknown": ["light.x"]}
+        body = json.dumps({"devices": {"switch.a": {"shard": "other"}}}).encode()
+        status, _, _ = await call(
+            state, "POST", "/api/v2/devices/batch", headers={"Content-Type": "application/json"}, body=body,
+        )
+        assert status == 422
+        assert devices.registry_version == version
+
+    asyncio.run(scenario())
@@ -0,0 +1,54 @@
+import asyncio
+
+from ha_api.dispatcher import CommandDispatcher
+
+
+def request(*entity_ids, domain="light"):
+    return {"domain": domain, "service": "turn_on", "target": {"entity_id": list(entity_ids)}}
+
+
+def test_per_entity_order_and_parallelism():
+    async def scenario():
+        log = []
+        running = 0
+        peak = 0
+
+        async def send(req):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            # Первая команда для light.a самая медленная
+            await asyncio.sleep(0.05 if req.get("slow") else 0.01)
+            log.append(req["n"])
+            running -= 1
+
+        dispatcher = CommandDispatcher(send, max_in_flight=2)
+        await dispatcher.submit({**request("light.a"), "n": 1, "slow": True})
+        await dispatcher.submit({**request("light.b"), "n": 2})
+        await dispatcher.submit({**request("light.a", "light.c"), "n": 3})
+        await dispatcher.drain()
+        assert log.index(1) < log.index(3)
+        assert log.index(2) < log.index(1)
+        assert peak <= 2
+        assert dispatcher.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_timeout_and_errors_reported():
+    async def scenario():
+        done = []
+
+        async def send(req):
+            if req["service"] == "fail":
+                raise RuntimeError
+            await asyncio.sleep(1)
+
+        dispatcher = CommandDispatcher(send, timeout=0.01, on_done=lambda req, ok: done.append((req["service"], ok)))
+        await dispatcher.submit(request("light.a"))
+        await dispatcher.submit({**request("light.b"), "service": "fail"})
+        await dispatcher.drain()
+        assert sorted(done) == [("fail", False), ("turn_on", False)]
+        assert dispatcher.stats()["latency"]["light"]["errors"] == 2
+
+    asyncio.run(scenario())
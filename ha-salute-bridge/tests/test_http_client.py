@@ -0,0 +1,77 @@
+import asyncio
+import codecs
+import json
+
+import pytest
+from aiohttp import web
+
+from http_client import HttpClient, JsonArrayParser
+
+BODY = '[{"a": 1}, 1500.0, -2, 1e3, "стр\\"ока", true, null, [1, [2]], {"b": [3, {}]}, 0.5e-1]'
+
+
+def parse(chunks: list[bytes]) -> list:
+    parser = JsonArrayParser()
+    text = codecs.getincrementaldecoder('utf-8')()
+    items = []
+    for chunk in chunks:
+        items.extend(parser.feed(text.decode(chunk)))
+    items.extend(parser.feed(text.decode(b'', final=True), final=True))
+    return items
+
+
+@pytest.mark.parametrize("body", [BODY, ' [ 1 , 2 ] \n', '[]', '[[]]', '[{"a": 1}, 1500.0]'])
+def test_split_at_every_byte(body):
+    data = body.encode()
+    expected = json.loads(body)
+    for cut in range(len(data) + 1):
+        assert parse([data[:cut], data[cut:]]) == expected, cut
+
+
+def test_byte_by_byte():
+    data = BODY.encode()
+    assert parse([data[i:i + 1] for i in range(len(data))]) == json.loads(BODY)
+
+
+def test_nested_arrays_are_items():
+    assert parse([b'[[1],[2]]']) == [[1], [2]]
+
+
+@pytest.mark.parametrize("body", [
+    '', '1', '{}', '[1', '[1,', '[1 2]', '[1,]', '[,1]', '[1]]', '[1] 2', ',[1]', '[1500.]', '[-]',
+])
+def test_invalid(body):
+    data = body.encode()
+    for cut in range(len(data) + 1):
+        with pytest.raises(ValueError):
+            parse([data[:cut], data[cut:]])
+
+
+def test_iter_json_array_over_http():
+    data = BODY.encode()
+
+    async def handler(request):
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        for i in range(0, len(data), 7):
+            await resp.write(data[i:i + 7])
+            await asyncio.sleep(0)
+        await resp.write_eof()
+        return resp
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/states', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        http = HttpClient()
+        try:
+            return [item async for item in http.iter_json_array(f'http://127.0.0.1:{port}/states')]
+        finally:
+            await http.close()
+            await runner.cleanup()
+
+    assert asyncio.run(scenario()) == json.loads(BODY)
@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+
+from queues import CoalescingQueue, Debounce, OverflowPolicy, merge_pending
+
+
+def mqtt_queue(maxsize=3, overflow=OverflowPolicy.drop_oldest):
+    return CoalescingQueue(
+        key=lambda item: (item["type"], item.get("data")),
+        maxsize=maxsize,
+        overflow=overflow,
+        droppable=lambda item: item["type"] == "status",
+        merge=merge_pending,
+    )
+
+
+def status(entity_id, ts=0.0, **kwargs):
+    return {"type": "status", "data": entity_id, "ts": ts, **kwargs}
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+        queue.task_done()
+    return items
+
+
+def test_coalesces_in_place():
+    queue = mqtt_queue()
+    queue.put_nowait(status("light.a"))
+    queue.put_nowait(status("light.b"))
+    queue.put_nowait(status("light.a", ts=5.0, force=False))
+    assert queue.coalesced == 1
+    assert [item["data"] for item in drain(queue)] == ["light.a", "light.b"]
+
+
+def test_merge_keeps_enqueue_time_and_force():
+    queue = mqtt_queue()
+    queue.put_nowait(status("light.a", ts=1.0, force=True))
+    queue.put_nowait(status("light.a", ts=2.0))
+    (item,) = drain(queue)
+    assert item["ts"] == 1.0
+    assert item["force"] is True
+
+
+def test_drop_oldest_keeps_control_items():
+    queue = mqtt_queue(maxsize=3)
+    queue.put_nowait({"type": "conf"})
+    queue.put_nowait({"type": "resync", "data": ("light.a",)})
+    queue.put_nowait(status("light.a"))
+    queue.put_nowait(status("light.b"))
+    assert queue.dropped == 1
+    assert [item["type"] for item in drain(queue)] == ["conf", "resync", "status"]
+
+
+def test_control_items_are_accepted_over_maxsize():
+    queue = mqtt_queue(maxsize=2)
+    queue.put_nowait(status("light.a"))
+    queue.put_nowait(status("light.b"))
+    queue.put_nowait({"type": "conf"})
+    assert queue.dropped == 0
+    assert queue.qsize() == 3
+
+
+def test_new_status_dropped_when_only_control_items_wait():
+    queue = mqtt_queue(maxsize=1)
+    queue.put_nowait({"type": "conf"})
+    queue.put_nowait(status("light.a"))
+    assert queue.dropped == 1
+    assert [item["type"] for item in drain(queue)] == ["conf"]
+
+
+def test_unkeyed_items_are_never_dropped():
+    queue = CoalescingQueue(key=lambda item: None, maxsize=1)
+    queue.put_nowait("a")
+    queue.put_nowait("b")
+    assert queue.dropped == 0
+    assert drain(queue) == ["a", "b"]
+
+
+def test_drop_newest():
+    queue = mqtt_queue(maxsize=1, overflow=OverflowPolicy.drop_newest)
+    queue.put_nowait(status("light.a"))
+    queue.put_nowait(status("light.b"))
+    assert queue.dropped == 1
+    assert [item["data"] for item in drain(queue)] == ["light.a"]
+
+
+def test_block_waits_for_room():
+    async def scenario():
+        queue = mqtt_queue(maxsize=1, overflow=OverflowPolicy.block)
+        await queue.put(status("light.a"))
+        waiter = asyncio.create_task(queue.put(status("light.b")))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        # Тот же ключ и служебные элементы не ждут
+        await asyncio.wait_for(queue.put(status("light.a", ts=1.0)), 0.1)
+        await asyncio.wait_for(queue.put({"type": "conf"}), 0.1)
+        assert (await queue.get())["data"] == "light.a"
+        queue.task_done()
+        assert (await queue.get())["type"] == "conf"
+        queue.task_done()
+        await asyncio.wait_for(waiter, 0.1)
+        assert (await queue.get())["data"] == "light.b"
+        queue.task_done()
+        await asyncio.wait_for(queue.join(), 0.1)
+
+    asyncio.run(scenario())
+
+
+def test_task_done_too_many_times():
+    queue = mqtt_queue()
+    with pytest.raises(ValueError):
+        queue.task_done()
+
+
+def test_debounce_runs_once_after_quiet_period():
+    async def scenario():
+        calls = []
+
+        async def func():
+            calls.append(asyncio.get_running_loop().time())
+
+        debounce = Debounce(func, delay=0.05)
+        start = asyncio.get_running_loop().time()
+        for _ in range(3):
+            debounce.schedule()
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        assert len(calls) == 1
+        assert calls[0] - start >= 0.05
+
+    asyncio.run(scenario())
+
+
+def test_debounce_max_delay():
+    async def scenario():
+        calls = []
+
+        async def func():
+            calls.append(1)
+
+        debounce = Debounce(func, delay=0.05, max_delay=0.1)
+        for _ in range(15):
+            debounce.schedule()
+            await asyncio.sleep(0.02)
+        assert len(calls) >= 2
+
+    asyncio.run(scenario())
+
+
+def test_debounce_flush():
+    async def scenario():
+        calls = []
+
+        async def func():
+            calls.append(1)
+
+        debounce = Debounce(func, delay=10)
+        # Без отложенного вызова flush ничего не делает
+        await debounce.flush()
+        assert calls == []
+        debounce.schedule()
+        debounce.schedule()
+        await asyncio.wait_for(debounce.flush(), 0.1)
+        assert calls == [1]
+        # Следующий schedule - новая серия
+        debounce.schedule()
+        await asyncio.wait_for(debounce.flush(), 0.1)
+        assert calls == [1, 1]
+
+    asyncio.run(scenario())
+
+
+def test_debounce_survives_errors():
+    async def scenario():
+        calls = []
+
+        async def func():
+            calls.append(1)
+            raise RuntimeError
+
+        debounce = Debounce(func, delay=10)
+        debounce.schedule()
+        await debounce.flush()
+        debounce.schedule()
+        await debounce.flush()
+        assert calls == [1, 1]
+
+    asyncio.run(scenario())
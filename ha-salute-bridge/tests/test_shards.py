@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from devices import DeviceModel, Devices
+from queues import CoalescingQueue
+from salute.base import SaluteClient
+from salute.shards import ShardMap, ShardedQueue, accounts_from_options
+
+ENTITY_IDS = [f"light.l{i}" for i in range(200)]
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+        queue.task_done()
+    return items
+
+
+@pytest.fixture
+def devices(tmp_path):
+    devices = Devices(str(tmp_path / 'devices.json'))
+    for key in ENTITY_IDS[:10]:
+        devices.update(key, DeviceModel(entity_id=key.split('.')[1], category="light", state="on", enabled=True))
+    return devices
+
+
+def test_single_account_owns_everything():
+    shards = ShardMap(["a"])
+    assert {shards.shard(entity_id) for entity_id in ENTITY_IDS} == {"a"}
+
+
+def test_hash_spreads_and_is_stable():
+    shards = ShardMap(["a", "b", "c"])
+    owners = {entity_id: shards.shard(entity_id) for entity_id in ENTITY_IDS}
+    assert set(owners.values()) == {"a", "b", "c"}
+    assert owners == {entity_id: ShardMap(["c", "a", "b"]).shard(entity_id) for entity_id in ENTITY_IDS}
+
+
+def test_adding_account_moves_devices_only_to_it():
+    before = ShardMap(["a", "b"])
+    after = ShardMap(["a", "b", "c"])
+    moved = [entity_id for entity_id in ENTITY_IDS if before.shard(entity_id) != after.shard(entity_id)]
+    assert moved
+    assert {after.shard(entity_id) for entity_id in moved} == {"c"}
+    # Примерно треть, а не почти все, как при crc32 % n
+    assert len(moved) < len(ENTITY_IDS) / 2
+
+
+def test_explicit_shard():
+    shards = ShardMap(["a", "b"])
+    entity_id = next(entity_id for entity_id in ENTITY_IDS if shards.shard(entity_id) == "a")
+    assert shards.shard(entity_id, DeviceModel(entity_id="x", category="light", state="on", shard="b")) == "b"
+    # Неизвестная учётная запись - по хэшу
+    assert shards.shard(entity_id, DeviceModel(entity_id="x", category="light", state="on", shard="zzz")) == "a"
+
+
+def test_accounts_from_options_skips_duplicates():
+    options = {
+        "sd_mqtt_login": "a", "sd_mqtt_password": "1",
+        "sd_mqtt_accounts": [{"login": "b", "password": "2"}, {"login": "a", "password": "3"}],
+    }
+    assert accounts_from_options(options) == [{"login": "a", "password": "1"}, {"login": "b", "password": "2"}]
+
+
+def test_sharded_queue_routes_items(devices):
+    async def scenario():
+        shards = ShardMap(["a", "b"])
+        queues = {login: CoalescingQueue(key=lambda item: (item["type"], item.get("data"))) for login in shards.logins}
+        queue = ShardedQueue(queues, shards, devices)
+        keys = sorted(devices.keys())
+        for key in keys:
+            await queue.put({"type": "status", "data": key})
+        await queue.put({"type": "resync", "data": tuple(keys)})
+        await queue.put({"type": "conf"})
+        for login, shard_queue in queues.items():
+            owned = [key for key in keys if queue.shard_of(key) == login]
+            items = drain(shard_queue)
+            assert [item["data"] for item in items if item["type"] == "status"] == owned
+            resync = [item["data"] for item in items if item["type"] == "resync"]
+            assert resync == ([tuple(owned)] if owned else [])
+            assert {"type": "conf"} in items
+
+    asyncio.run(scenario())
+
+
+def test_move_hands_device_to_new_owner(devices):
+    shards = ShardMap(["a", "b"])
+    queues = {login: CoalescingQueue(key=lambda item: (item["type"], item.get("data"))) for login in shards.logins}
+    queue = ShardedQueue(queues, shards, devices)
+    options = {"sd_mqtt_login": "a", "sd_mqtt_password": ""}
+    clients = {
+        login: SaluteClient(
+            options, queue_write=None, queue_read=queues[login], devices=devices, categories_file="",
+            http=None, account={"login": login, "password": ""}, shards=shards,
+        )
+        for login in shards.logins
+    }
+    key = "light.l0"
+    old = queue.shard_of(key)
+    new = "b" if old == "a" else "a"
+    clients[old].published_states[key] = "fragment"
+
+    devices.update(key, {"shard": new})
+
+    assert drain(queues[old]) == []
+    items = drain(queues[new])
+    # Сначала конфигурация с устройством, затем его состояние
+    assert [(item["type"], item.get("data")) for item in items] == [("conf", None), ("status", key)]
+    assert key not in clients[old].published_states
+
+    # Изменение без смены шарда ничего не переносит
+    devices.update(key, {"name": "Новое имя"})
+    assert drain(queues[new]) == []
@@ -0,0 +1,70 @@
+import os
+import stat
+
+from devices import DeviceModel, Devices
+from storage import Journal
+from utils import json_read, json_write, write_atomic
+
+
+def mode(path) -> int:
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_write_atomic_keeps_existing_mode(tmp_path):
+    path = tmp_path / 'devices.json'
+    path.write_bytes(b'{}')
+    os.chmod(path, 0o644)
+    write_atomic(str(path), b'{"a": 1}')
+    assert path.read_bytes() == b'{"a": 1}'
+    assert mode(path) == 0o644
+
+
+def test_write_atomic_new_file_uses_umask(tmp_path):
+    path = tmp_path / 'options.json'
+    umask = os.umask(0o027)
+    try:
+        json_write(str(path), {"a": 1})
+    finally:
+        os.umask(umask)
+    reference = tmp_path / 'reference'
+    reference.touch()
+    assert mode(path) == mode(reference)
+    assert json_read(str(path)) == {"a": 1}
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_journal_replay_after_partial_write(tmp_path):
+    path = tmp_path / 'devices.json.journal'
+    journal = Journal(str(path))
+    journal.append([{"key": "light.a", "n": 1}, {"key": "light.b", "n": 2}])
+    # Сбой посреди записи: последняя строка без перевода строки
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"key": "light.c", "n"')
+
+    journal = Journal(str(path))
+    assert list(journal.read()) == [{"key": "light.a", "n": 1}, {"key": "light.b", "n": 2}]
+    journal.append([{"key": "light.d", "n": 4}])
+    assert [record["key"] for record in Journal(str(path)).read()] == ["light.a", "light.b", "light.d"]
+
+
+def test_journal_skips_corrupted_line(tmp_path):
+    path = tmp_path / 'devices.json.journal'
+    path.write_text('{"key": "light.a"}\n{oops\n{"key": "light.b"}\n', encoding='utf-8')
+    assert [record["key"] for record in Journal(str(path)).read()] == ["light.a", "light.b"]
+
+
+def test_devices_replay_journal(tmp_path):
+    fname = str(tmp_path / 'devices.json')
+    devices = Devices(fname, journal=True, compact_interval=3600)
+    devices.update('light.a', DeviceModel(entity_id='a', name='A', category='light', state='on'))
+    devices.save()
+    devices.update('light.a', {"state": "off"})
+    devices.save()
+    assert not os.path.exists(fname)
+
+    with open(f'{fname}.journal', 'a', encoding='utf-8') as f:
+        f.write('{"key": "light.a", "device": {"entity_id"')
+
+    restored = Devices(fname, journal=True, compact_interval=3600)
+    assert restored.get('light.a').state == "off"
+    assert restored.get('light.a').name == "A"